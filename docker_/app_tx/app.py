@@ -1,12 +1,27 @@
 import os
-import pyvips
 import re
+import sys
+import io
 import json
+import hmac
+import math
+import time
+import uuid
+import random
+import base64
+import hashlib
+import cProfile
+import functools
+import threading
+import collections
+import shutil
 import mimetypes
+import concurrent.futures
 
-from flask import Flask, request, make_response, send_file, Response
-from PIL import Image
+from flask import Flask, request, make_response, send_file, Response, g, redirect
+from PIL import Image, ImageDraw, ImageFont, ImageColor, ImageFilter, ImageStat
 from werkzeug.routing import BaseConverter
+from urllib.parse import urlencode, urlparse, quote
 
 from google.cloud import storage
 
@@ -22,6 +37,183 @@ EXIF = "exif"
 IMAGE_MOGR = "imageMogr2"
 WATER_MARK = "watermark"
 IMAGE_AVE = "imageAve"
+SRCSET = "srcset"
+
+# 单请求profiling：只有携带正确token的请求才会被采样，未配置token时完全关闭
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.getcwd() + '/profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+# PROFILE_DIR里最多保留的profile个数，超出时删除最旧的
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '200'))
+
+# heic编码参数，可按请求覆盖
+HEIC_QUALITY = int(os.getenv('HEIC_QUALITY', '50'))
+HEIC_EFFORT = os.getenv('HEIC_EFFORT') or None
+HEIC_LOSSLESS = os.getenv('HEIC_LOSSLESS', '0') == '1'
+
+# format/auto 协商时的候选格式，按优先级排列
+AUTO_FORMATS = [f.strip() for f in os.getenv('AUTO_FORMATS', 'avif,webp').split(',') if f.strip()]
+
+# Client Hints：宽度写auto时按Sec-CH-Width/Width（物理像素）或Sec-CH-Viewport-Width/Viewport-Width（CSS像素）乘DPR算出宽度，
+# 向上取到HINT_WIDTHS里的一档，控制衍生图的数量；DPR最多按HINT_MAX_DPR算，没有任何提示时用HINT_DEFAULT_WIDTH
+HINT_WIDTHS = sorted(int(w) for w in os.getenv('HINT_WIDTHS', '160,320,480,640,960,1280,1920,2560').split(','))
+HINT_MAX_DPR = float(os.getenv('HINT_MAX_DPR', '2'))
+HINT_DEFAULT_WIDTH = int(os.getenv('HINT_DEFAULT_WIDTH', '960'))
+# Save-Data: on 时宽度为auto的请求的质量上限
+SAVE_DATA_QUALITY = int(os.getenv('SAVE_DATA_QUALITY', '50'))
+ACCEPT_CH = os.getenv('ACCEPT_CH', 'Sec-CH-DPR, Sec-CH-Width, Sec-CH-Viewport-Width, DPR, Width, Viewport-Width')
+
+# 编码预设。strip为True时不写入EXIF/ICC；png的compress_type为zlib策略（1=FILTERED，3=RLE）
+ENCODER_PROFILES = {
+    'default': {
+        'strip': True,
+        'jpeg': {'quality': 75, 'optimize': True, 'subsampling': '4:2:0'},
+        'png': {'compress_level': 6},
+        'webp': {'quality': 80, 'method': 4},
+        'avif': {'quality': 60, 'speed': 6},
+        'heic': {},
+    },
+    'fast': {
+        'strip': True,
+        'jpeg': {'quality': 75, 'subsampling': '4:2:0'},
+        'png': {'compress_level': 1, 'compress_type': 3},
+        'webp': {'quality': 75, 'method': 0},
+        'avif': {'quality': 55, 'speed': 10},
+        'heic': {'effort': 0},
+    },
+    'small': {
+        'strip': True,
+        'jpeg': {'quality': 70, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+        'png': {'optimize': True, 'compress_type': 1},
+        'webp': {'quality': 70, 'method': 6},
+        'avif': {'quality': 50, 'speed': 4},
+        'heic': {'quality': 40, 'effort': 8},
+    },
+    'archive': {
+        'strip': False,
+        'jpeg': {'quality': 92, 'optimize': True, 'subsampling': '4:4:4'},
+        'png': {'compress_level': 9},
+        'webp': {'quality': 90, 'method': 4},
+        'avif': {'quality': 80, 'speed': 6},
+        'heic': {'quality': 80},
+    },
+}
+ENCODER_PROFILE = os.getenv('ENCODER_PROFILE', 'default')
+
+# 缩放预设：(最终滤镜, reducing_gap)。缩小倍数超过reducing_gap时先做整数倍box缩小（JPEG直接在解码时缩小），
+# 再用滤镜完成剩余部分；reducing_gap为None表示单次全尺寸重采样
+RESAMPLE_PRESETS = {
+    'fast': (Image.BILINEAR, 2.0),
+    'balanced': (Image.BICUBIC, 2.5),
+    'quality': (Image.LANCZOS, 3.0),
+    'exact': (Image.LANCZOS, None),
+    # 改造前的做法：im.resize(size)，即PIL默认的BICUBIC单次全尺寸重采样，不在解码时缩小
+    'baseline': (Image.BICUBIC, None),
+}
+RESAMPLE_PRESET = os.getenv('RESAMPLE_PRESET', 'balanced')
+
+# crop/resize/auto-orient合并成一次重采样，0时逐步执行
+FUSE_GEOMETRY = os.getenv('FUSE_GEOMETRY', '1') == '1'
+
+# 智能裁剪：在长边FOCAL_PROXY像素的代理图上，按FOCAL_CELL像素的格子打分找焦点
+FOCAL_PROXY = int(os.getenv('FOCAL_PROXY', '128'))
+FOCAL_CELL = int(os.getenv('FOCAL_CELL', '8'))
+
+# 衍生图存储：<DERIVATIVE_DIR>/<原图key>/<处理参数key>.<格式>
+DERIVATIVE_DIR = os.getenv('DERIVATIVE_DIR', os.getcwd() + '/derivatives')
+
+# srcset默认的宽度阶梯
+SRCSET_WIDTHS = [int(w) for w in os.getenv('SRCSET_WIDTHS', '320,640,960,1280,1920').split(',')]
+
+# 原图逐级减半的缩小图持久化到衍生图存储（<原图key>/levels/），任意尺寸从最近的更大一级开始缩放
+LEVEL_CACHE = os.getenv('LEVEL_CACHE', '1') == '1'
+LEVEL_QUALITY = int(os.getenv('LEVEL_QUALITY', '95'))
+
+# Deep Zoom瓦片：/_dzi/<原图>.dzi 描述文件，/_dzi/<原图>_files/<级别>/<列>_<行>.<格式> 瓦片
+TILE_SIZE = int(os.getenv('TILE_SIZE', '254'))
+TILE_OVERLAP = int(os.getenv('TILE_OVERLAP', '1'))
+TILE_FORMAT = os.getenv('TILE_FORMAT', 'jpeg')
+TILE_MAX_AGE = int(os.getenv('TILE_MAX_AGE', '31536000'))
+# 进程内最多同时保留几张原图的瓦片金字塔
+TILE_SOURCES = int(os.getenv('TILE_SOURCES', '4'))
+
+# 超过这个像素数的原图不整张解码，改由vips顺序读取、边解码边缩小，内存只和输出尺寸有关；0为关闭。
+# 默认和PIL的解压炸弹上限（Image.MAX_IMAGE_PIXELS）一致，超过上限的原图只有缩放/裁剪能处理，见open_source
+STREAM_PIXELS = int(os.getenv('STREAM_PIXELS', str(Image.MAX_IMAGE_PIXELS or 0)))
+
+# 源站下载：超过DOWNLOAD_PARALLEL_MIN字节的对象按DOWNLOAD_CHUNK切段，并发Range读取
+DOWNLOAD_CHUNK = int(os.getenv('DOWNLOAD_CHUNK', str(8 * 1024 * 1024)))
+DOWNLOAD_PARALLEL_MIN = int(os.getenv('DOWNLOAD_PARALLEL_MIN', str(16 * 1024 * 1024)))
+# 单个请求的并发段数；整个进程同时在下载的连接数上限
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_CONNECTIONS = threading.BoundedSemaphore(int(os.getenv('DOWNLOAD_CONNECTIONS', '16')))
+
+# 负缓存：不存在(404)或无法解码(422)的原图在NEGATIVE_TTL秒内直接返回，不再访问源站，响应也带同样的缓存时间
+NEGATIVE_TTL = int(os.getenv('NEGATIVE_TTL', '60'))
+
+# 源站读取：每次尝试的超时上限、可重试错误的重试次数和退避基数（秒，带随机抖动）
+ORIGIN_TIMEOUT = float(os.getenv('ORIGIN_TIMEOUT', '5'))
+ORIGIN_RETRIES = int(os.getenv('ORIGIN_RETRIES', '2'))
+ORIGIN_BACKOFF = float(os.getenv('ORIGIN_BACKOFF', '0.1'))
+# 对冲请求：单流下载超过近期p95耗时（样本不足时用ORIGIN_HEDGE_DELAY）还没完成，就再发一个相同的请求
+ORIGIN_HEDGE = os.getenv('ORIGIN_HEDGE', '1') == '1'
+ORIGIN_HEDGE_DELAY = float(os.getenv('ORIGIN_HEDGE_DELAY', '1'))
+ORIGIN_HEDGE_MIN = float(os.getenv('ORIGIN_HEDGE_MIN', '0.05'))
+# 每个请求的总时间预算（秒）；原图取回后剩余不足DEGRADE_BUDGET时用fast缩放/编码，结果不进衍生图存储
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '10'))
+DEGRADE_BUDGET = float(os.getenv('DEGRADE_BUDGET', '2'))
+NEGATIVE_CACHE_SIZE = int(os.getenv('NEGATIVE_CACHE_SIZE', '10000'))
+
+# 水印：默认字体、按名字查找字体的目录、进程内缓存的已渲染水印层数量
+WATERMARK_FONT = os.getenv('WATERMARK_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+WATERMARK_FONT_DIR = os.getenv('WATERMARK_FONT_DIR', '/usr/share/fonts/truetype')
+WATERMARK_CACHE_SIZE = int(os.getenv('WATERMARK_CACHE_SIZE', '64'))
+
+# 模糊：sigma超过这个值时在缩小的图上做，缩小倍数约为sigma/BLUR_FAST_SIGMA；0为始终在原尺寸上做
+BLUR_FAST_SIGMA = float(os.getenv('BLUR_FAST_SIGMA', '2'))
+
+# 响应缓存策略，按路由和结果类型区分；CACHE_POLICIES环境变量（JSON）可以覆盖其中的字段，
+# 如 {"derivative": {"max_age": 3600, "s_maxage": 604800}}
+CACHE_POLICIES = {
+    'original': {'max_age': 86400, 'stale_while_revalidate': 3600, 'stale_if_error': 86400},
+    'derivative': {'max_age': 86400, 'stale_while_revalidate': 3600, 'stale_if_error': 86400},
+    'dzi': {'max_age': 86400, 'stale_while_revalidate': 3600, 'stale_if_error': 86400},
+    'tile': {'max_age': TILE_MAX_AGE, 'immutable': True, 'stale_if_error': 86400},
+    'degraded': {'max_age': 60},
+    'negative': {'max_age': NEGATIVE_TTL},
+    'redirect': {'max_age': 86400},
+}
+for _name, _policy in json.loads(os.getenv('CACHE_POLICIES', '{}')).items():
+    CACHE_POLICIES.setdefault(_name, {}).update(_policy)
+# 每个响应都带上原图的代理缓存标签（Fastly为Surrogate-Key，Cloudflare为Cache-Tag），按原图清CDN缓存时用
+SURROGATE_KEY_HEADER = os.getenv('SURROGATE_KEY_HEADER', 'Surrogate-Key')
+# /_purge/<原图>：请求头X-Image-Purge与PURGE_TOKEN一致时清掉这张原图的本地衍生图并让CDN失效；
+# 配置了CDN_URL_MAP时调用Cloud CDN的invalidateCache（CDN_PROJECT默认取运行环境的项目）
+PURGE_TOKEN = os.getenv('PURGE_TOKEN')
+CDN_URL_MAP = os.getenv('CDN_URL_MAP')
+CDN_PROJECT = os.getenv('CDN_PROJECT')
+CDN_HOST = os.getenv('CDN_HOST')
+# 等价的处理参数统一成规范形式作为衍生图的key；CANONICAL_REDIRECT=1时非规范的地址301到规范地址，CDN上也只缓存一份
+CANONICAL_REDIRECT = os.getenv('CANONICAL_REDIRECT', '0') == '1'
+# 衍生图命中时，原图版本上次确认超过这么多秒就在后台重新读一次GCS元数据，原图重新上传后作废旧的衍生图；0为不检查
+DERIVATIVE_REVALIDATE = int(os.getenv('DERIVATIVE_REVALIDATE', '300'))
+
+# 调度：解码/处理/编码按估算成本（像素数 x 帧数 x (1 + 各操作权重之和)）分到各个lane排队，最多PROCESS_SLOTS个同时执行，
+# 其余线程仍可以下载原图、返回已有的衍生图；0为不限制
+PROCESS_SLOTS = int(os.getenv('PROCESS_SLOTS', '4'))
+# 按成本从小到大匹配第一个max_cost不小于成本的lane；slots为该lane最多占用的槽位数（0为不限），其余槽位留给别的lane；
+# weight为加权公平排队的权重。SCHEDULER_LANES环境变量（JSON列表）可以整体替换
+SCHEDULER_LANES = json.loads(os.getenv('SCHEDULER_LANES', 'null')) or [
+    {'name': 'light', 'max_cost': 40e6, 'weight': 4, 'slots': 0},
+    {'name': 'heavy', 'max_cost': None, 'weight': 1, 'slots': max(1, PROCESS_SLOTS // 2)},
+]
+# 成本估算里各操作的权重，JOB_WEIGHTS环境变量（JSON）可以覆盖其中的字段
+JOB_WEIGHTS = {'heic': 6, 'avif': 6, 'webp': 1, 'circle': 20, 'blur': 2, 'rotate': 1, 'watermark': 1}
+JOB_WEIGHTS.update(json.loads(os.getenv('JOB_WEIGHTS', '{}')))
+# 租户隔离：按原图路径的前SCHEDULER_TENANT_DEPTH段区分租户，各租户在lane内公平排队，
+# SCHEDULER_TENANT_SLOTS>0时每个租户最多同时占用这么多槽位；0为不区分
+SCHEDULER_TENANT_DEPTH = int(os.getenv('SCHEDULER_TENANT_DEPTH', '0'))
+SCHEDULER_TENANT_SLOTS = int(os.getenv('SCHEDULER_TENANT_SLOTS', '0'))
 
 
 def item_index(arr, item):
@@ -98,7 +290,8 @@ def parse_qs(query):
         encoded["strip"] = str("strip" in args)
         encoded["blur"] = str("blur" in args)
 
-        args_name = ["thumbnail", "gravity", "crop", "rotate", "format", "interlace"]
+        args_name = ["thumbnail", "gravity", "crop", "rotate", "format", "interlace", "quality", "profile",
+                     "resample", "background"]
         for arg_name in args_name:
             if arg_name in args:
                 try:
@@ -123,11 +316,406 @@ def parse_qs(query):
     return encoded
 
 
-def image_view_mode_1(im, w, h):
+def qs_first(d, name):
+    """
+    parse_qs结果里imageView2的参数是列表，imageMogr2的是字符串，这里统一取第一个值
+    """
+    value = d.get(name)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def encode_params(d):
+    """
+    从parse_qs的结果里取出编码相关参数：quality(q)/interlace/strip/profile
+    """
+    interlace = qs_first(d, 'interlace')
+    return {
+        'quality': qs_first(d, 'quality') or qs_first(d, 'q'),
+        'interlace': None if interlace is None else interlace == '1',
+        'strip': qs_first(d, 'strip') == 'True',
+        'profile': qs_first(d, 'profile'),
+    }
+
+
+# PIL transpose方法对应的2x2矩阵(a, b, c, d)：以图片中心为原点、y轴向下时 x' = a*x + b*y, y' = c*x + d*y
+TRANSPOSE_MATRICES = {
+    Image.FLIP_LEFT_RIGHT: (-1, 0, 0, 1),
+    Image.FLIP_TOP_BOTTOM: (1, 0, 0, -1),
+    Image.ROTATE_90: (0, 1, -1, 0),
+    Image.ROTATE_180: (-1, 0, 0, -1),
+    Image.ROTATE_270: (0, -1, 1, 0),
+    Image.TRANSPOSE: (0, 1, 1, 0),
+    Image.TRANSVERSE: (0, -1, -1, 0),
+}
+IDENTITY_MATRIX = (1, 0, 0, 1)
+
+
+def compose_matrix(m, n):
+    """
+    先做n再做m的合成矩阵 m·n
+    """
+    return (m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+            m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3])
+
+
+def matrix_transpose_method(m):
+    """
+    矩阵对应的单个PIL transpose方法，单位矩阵返回None
+    """
+    for method, matrix in TRANSPOSE_MATRICES.items():
+        if matrix == m:
+            return method
+    return None
+
+
+class GeometryPlan(object):
+    """
+    几何操作计划。对外模仿PIL Image的size/crop/transpose（缩放经由resize_image），
+    image_view_mode_*、image_mogr_crop、image_mogr_auto_orient可以原样作用在它上面，
+    但只记录变换：裁剪框折算回原图坐标，方向合成为一个transpose，
+    realize时用一次resize(box=...)从原图直接得到结果，不产生中间整图。
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.size = source.size
+        # 当前结果对应的原图区域（原图坐标，浮点）
+        self.box = (0.0, 0.0, float(source.size[0]), float(source.size[1]))
+        # 原图区域 -> 当前结果的方向变换
+        self.matrix = IDENTITY_MATRIX
+        self.preset = None
+        # 折算失败（如裁剪超出边界需要补边）时按原顺序逐步执行
+        self.fusable = True
+        self.ops = []
+
+    @property
+    def format(self):
+        return self.source.format
+
+    @property
+    def mode(self):
+        return self.source.mode
+
+    @property
+    def info(self):
+        return self.source.info
+
+    def _getexif(self):
+        return self.source._getexif()
+
+    def resize(self, size, preset=None):
+        size = (max(1, int(size[0])), max(1, int(size[1])))
+        self.ops.append(('resize', size, preset))
+        self.size = size
+        if preset:
+            self.preset = preset
+        return self
+
+    def crop(self, box):
+        self.ops.append(('crop', tuple(box)))
+        w, h = self.size
+        if box[0] < 0 or box[1] < 0 or box[2] > w or box[3] > h or box[2] <= box[0] or box[3] <= box[1]:
+            self.fusable = False
+        else:
+            # 当前结果上的裁剪框 -> 以中心为原点的归一化坐标 -> 逆方向变换（正交矩阵的逆即转置）-> 原图坐标
+            a, b, c, d = self.matrix
+            corners = []
+            for x, y in ((box[0], box[1]), (box[2], box[3])):
+                x = 2.0 * x / w - 1
+                y = 2.0 * y / h - 1
+                corners.append((a * x + c * y, b * x + d * y))
+            u0, u1 = sorted(p[0] for p in corners)
+            v0, v1 = sorted(p[1] for p in corners)
+            x0, y0, x1, y1 = self.box
+            bw, bh = x1 - x0, y1 - y0
+            self.box = (x0 + (u0 + 1) / 2 * bw, y0 + (v0 + 1) / 2 * bh,
+                        x0 + (u1 + 1) / 2 * bw, y0 + (v1 + 1) / 2 * bh)
+        self.size = (int(box[2] - box[0]), int(box[3] - box[1]))
+        return self
+
+    def transpose(self, method):
+        self.ops.append(('transpose', method))
+        m = TRANSPOSE_MATRICES[method]
+        self.matrix = compose_matrix(m, self.matrix)
+        if m[0] == 0:
+            self.size = (self.size[1], self.size[0])
+        return self
+
+    def realize(self, levels=None):
+        if not self.fusable:
+            return self.replay()
+        source = self.source
+        # 方向变换前的输出尺寸
+        out = self.size if self.matrix[0] != 0 else (self.size[1], self.size[0])
+        box = self.box
+        bw, bh = box[2] - box[0], box[3] - box[1]
+        if (abs(bw - out[0]) < 1e-6 and abs(bh - out[1]) < 1e-6
+                and all(abs(v - round(v)) < 1e-6 for v in box)):
+            # 纯裁剪
+            box = tuple(int(round(v)) for v in box)
+            if box == (0, 0) + source.size:
+                im = source
+            elif streamable(source):
+                im = stream_resize(source, box, out)
+            else:
+                im = source.crop(box)
+        else:
+            resample, reducing_gap = RESAMPLE_PRESETS.get(self.preset or RESAMPLE_PRESET) or RESAMPLE_PRESETS['balanced']
+            if streamable(source):
+                im = stream_resize(source, box, out, reducing_gap)
+            else:
+                if levels is not None:
+                    source, box = levels.pick(box, out, reducing_gap)
+                elif reducing_gap and source.format == 'JPEG' and source.tile:
+                    origin = source.size
+                    source.draft(source.mode, (int(origin[0] * out[0] / bw * reducing_gap),
+                                               int(origin[1] * out[1] / bh * reducing_gap)))
+                    sx = source.size[0] / origin[0]
+                    sy = source.size[1] / origin[1]
+                    box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+                im = source.resize(out, resample, box=box, reducing_gap=reducing_gap)
+        method = matrix_transpose_method(self.matrix)
+        if method is not None:
+            im = im.transpose(method)
+        return im
+
+    def replay(self):
+        im = self.source
+        for op in self.ops:
+            if op[0] == 'resize':
+                im = resize_image(im, op[1], op[2])
+            elif op[0] == 'crop':
+                im = im.crop(op[1])
+            else:
+                im = im.transpose(op[1])
+        return im
+
+
+class ImageLevels(object):
+    """
+    同一张原图按需生成的逐级减半金字塔（每一级由上一级reduce(2)得到），供多个衍生图共用
+    """
+    REDUCIBLE_MODES = ('L', 'LA', 'La', 'RGB', 'RGBA', 'RGBa', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F')
+
+    def __init__(self, source, store=None):
+        self.source = source
+        self.levels = {1: source}
+        # 可选的LevelStore，磁盘上已有的级别直接打开，新生成的级别写回磁盘
+        self.store = store
+
+    def get(self, factor):
+        if factor not in self.levels:
+            level = self.store.get(factor) if self.store else None
+            if level is None:
+                if factor > 1 and streamable(self.source):
+                    # 超大原图不解码整张，直接从文件流式缩小到这一级
+                    w, h = self.source.size
+                    level = stream_resize(self.source, (0, 0, w, h), (-(-w // factor), -(-h // factor)))
+                else:
+                    level = self.get(factor // 2).reduce(2)
+                if self.store:
+                    self.store.put(factor, level)
+            else:
+                # 磁盘上的级别不带原图的exif/icc，编码时仍以原图为准
+                level.info = dict(self.source.info)
+            self.levels[factor] = level
+        return self.levels[factor]
+
+    def pick(self, box, out, reducing_gap):
+        """
+        选出缩小后仍不小于 输出尺寸*reducing_gap 的最小一级，返回(该级图片, 换算到该级的box)
+        """
+        factor = 1
+        if reducing_gap and self.source.mode in self.REDUCIBLE_MODES:
+            bw, bh = box[2] - box[0], box[3] - box[1]
+            while bw / (factor * 2) >= out[0] * reducing_gap and bh / (factor * 2) >= out[1] * reducing_gap:
+                factor *= 2
+        level = self.get(factor)
+        sx = level.size[0] / self.source.size[0]
+        sy = level.size[1] / self.source.size[1]
+        return level, (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+
+
+class LevelStore(object):
+    """
+    ImageLevels的磁盘持久化：每张原图一个目录，每一级一个文件（L/RGB/CMYK存高质量JPEG，带透明通道的存PNG），
+    meta.json记录原图指纹，原图变化后整个目录作废重建
+    """
+    JPEG_MODES = ('L', 'RGB', 'CMYK')
+    PNG_MODES = ('LA', 'RGBA')
+
+    def __init__(self, route_file, source):
+        self.dir = os.path.join(DERIVATIVE_DIR, source_key(route_file), 'levels')
+        filename = getattr(source, 'filename', '')
+        self.fingerprint = '{}x{}/{}/{}'.format(source.size[0], source.size[1], source.mode,
+                                               os.path.getsize(filename) if filename else 0)
+        meta = os.path.join(self.dir, 'meta.json')
+        try:
+            with open(meta) as fd:
+                current = json.load(fd).get('fingerprint')
+        except (OSError, ValueError):
+            current = None
+        if current != self.fingerprint:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            os.makedirs(self.dir, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(meta, uuid.uuid4().hex)
+            with open(tmp, 'w') as fd:
+                json.dump({'fingerprint': self.fingerprint, 'size': list(source.size), 'mode': source.mode}, fd)
+            os.replace(tmp, meta)
+
+    def path(self, factor, mode):
+        ext = 'jpg' if mode in self.JPEG_MODES else 'png'
+        return os.path.join(self.dir, '{}.{}'.format(factor, ext))
+
+    def get(self, factor):
+        for ext in ('jpg', 'png'):
+            path = os.path.join(self.dir, '{}.{}'.format(factor, ext))
+            if os.path.exists(path):
+                return Image.open(path)
+        return None
+
+    def put(self, factor, im):
+        """
+        后台线程写盘，不占用当前请求的时间
+        """
+        if im.mode not in self.JPEG_MODES + self.PNG_MODES:
+            return
+        threading.Thread(target=self._write, args=(self.path(factor, im.mode), im), daemon=True).start()
+
+    def _write(self, path, im):
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            if im.mode in self.JPEG_MODES:
+                im.save(tmp, 'JPEG', quality=LEVEL_QUALITY, subsampling=0)
+            else:
+                im.save(tmp, 'PNG', compress_level=1)
+            os.replace(tmp, path)
+        except OSError as e:
+            print('level cache write failed: {}'.format(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def open_levels(route_file, source):
+    """
+    原图的ImageLevels，LEVEL_CACHE开启时带上磁盘持久化
+    """
+    return ImageLevels(source, LevelStore(route_file, source) if LEVEL_CACHE else None)
+
+
+def realize(im, levels=None):
+    """
+    GeometryPlan落地成真正的图片，普通图片原样返回
+    :param levels: 可选的ImageLevels，缩放时从合适的一级开始
+    """
+    if isinstance(im, GeometryPlan):
+        return im.realize(levels)
+    return im
+
+
+def plan_geometry(im):
+    """
+    FUSE_GEOMETRY开启时把刚打开的图片包成GeometryPlan
+    """
+    if FUSE_GEOMETRY:
+        return GeometryPlan(im)
+    return im
+
+
+def streamable(im):
+    """
+    还未解码、且像素数超过STREAM_PIXELS的原图文件，走stream_resize
+    """
+    return bool(STREAM_PIXELS and isinstance(im, Image.Image) and getattr(im, 'tile', None) and getattr(im, 'filename', '')
+                and im.format != 'GIF' and im.size[0] * im.size[1] > STREAM_PIXELS)
+
+
+def open_source(path):
+    """
+    打开原图，只读文件头。PIL的解压炸弹上限保持默认：
+    像素数超过上限两倍的原图PIL拒绝打开，按解码失败处理；超过上限的原图只能流式缩放/裁剪，
+    格式转换、模糊、旋转、水印、GIF等需要在PIL里整张解码时抛DecompressionBombError
+    """
+    try:
+        im = Image.open(path)
+    except Image.DecompressionBombError as e:
+        raise OSError(str(e))
+    limit = Image.MAX_IMAGE_PIXELS
+    if limit and im.size[0] * im.size[1] > limit:
+        load = im.load
+
+        def checked_load():
+            # draft缩小到上限以内的JPEG照常解码
+            if im.tile and im.size[0] * im.size[1] > limit:
+                raise Image.DecompressionBombError('image too large: {}x{}'.format(im.size[0], im.size[1]))
+            return load()
+        im.load = checked_load
+    return im
+
+
+def stream_resize(im, box, size, reducing_gap=None):
+    """
+    用vips顺序读取原图文件，按条带解码、裁剪、缩小，只在最后把输出尺寸的结果转成PIL图片，
+    峰值内存取决于输出尺寸和条带高度，而不是原图像素数
+    :param im: PIL打开但未解码的原图
+    :param box: 原图坐标下的区域
+    :param size: 输出尺寸
+    """
+    import pyvips
+
+    options = {'access': 'sequential'}
+    bw, bh = box[2] - box[0], box[3] - box[1]
+    if im.format == 'JPEG':
+        # 和draft一样在DCT阶段先缩小1/2、1/4、1/8
+        shrink = 1
+        gap = reducing_gap or 1
+        while shrink < 8 and bw / (shrink * 2) >= size[0] * gap and bh / (shrink * 2) >= size[1] * gap:
+            shrink *= 2
+        options['shrink'] = shrink
+    v = pyvips.Image.new_from_file(im.filename, **options)
+    sx = v.width / im.size[0]
+    sy = v.height / im.size[1]
+    left, top = int(box[0] * sx), int(box[1] * sy)
+    width = max(1, min(v.width, int(math.ceil(box[2] * sx))) - left)
+    height = max(1, min(v.height, int(math.ceil(box[3] * sy))) - top)
+    if (left, top, width, height) != (0, 0, v.width, v.height):
+        v = v.crop(left, top, width, height)
+    if (width, height) != tuple(size):
+        # 方向由GeometryPlan处理，这里不能按EXIF再转一次
+        v = v.thumbnail_image(size[0], height=size[1], size='force', no_rotate=True)
+    if v.interpretation not in ('srgb', 'b-w') or v.format != 'uchar':
+        v = v.colourspace('b-w' if v.bands < 3 else 'srgb')
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[v.bands]
+    out = Image.frombytes(mode, (v.width, v.height), v.write_to_memory())
+    out.info = dict(im.info)
+    return out
+
+
+def resize_image(im, size, preset=None):
+    """
+    按缩放预设缩放到size
+    :param preset: RESAMPLE_PRESETS中的名字，默认RESAMPLE_PRESET
+    """
+    if isinstance(im, GeometryPlan):
+        return im.resize(size, preset)
+    resample, reducing_gap = RESAMPLE_PRESETS.get(preset or RESAMPLE_PRESET) or RESAMPLE_PRESETS['balanced']
+    size = (max(1, int(size[0])), max(1, int(size[1])))
+    if streamable(im):
+        return stream_resize(im, (0, 0) + im.size, size, reducing_gap)
+    if reducing_gap and im.format == 'JPEG' and im.tile:
+        # 还未解码的JPEG可以在DCT阶段按1/2、1/4、1/8缩小，省掉大部分解码开销
+        im.draft(im.mode, (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+    return im.resize(size, resample, reducing_gap=reducing_gap)
+
+
+def image_view_mode_1(im, w, h, preset=None, gravity=None, route_file=None):
     """
     限定缩略图的宽最少为<Width>，高最少为<Height>，进行等比缩放，居中裁剪。
     转后的缩略图通常恰好是 <Width>x<Height> 的大小（有一个边缩放的时候会因为超出矩形框而被裁剪掉多余部分）。
     如果只指定 w 参数或只指定 h 参数，代表限定为长宽相等的正方图。
+    gravity为smart时以focal_point为中心裁剪
     """
     if not w and not h:
         return
@@ -151,21 +739,29 @@ def image_view_mode_1(im, w, h):
     if min_ratio >= 1:  # 两边都大
         return im
 
+    # 焦点在缩放前取，缩放前的图还能直接用原图上缓存的焦点
+    point = focal_point(im, route_file) if gravity == 'smart' else None
     if max_ratio < 1:  # 两边均小于原来
         # 新规格
-        size = resize = tuple(int(x * max_ratio) for x in size)
-        im = im.resize(resize)
-    box = []
-    box.append(int((size[0] - w) / 2))
-    box.append(int((size[1] - h) / 2))
-    box.append(w + box[0])
-    box.append(h + box[1])
+        resize = tuple(int(x * max_ratio) for x in size)
+        if point:
+            point = [point[0] * resize[0] / size[0], point[1] * resize[1] / size[1]]
+        size = resize
+        im = resize_image(im, resize, preset)
+    if point and w <= size[0] and h <= size[1]:
+        box = list(get_box(size, point, w, h))
+    else:
+        box = []
+        box.append(int((size[0] - w) / 2))
+        box.append(int((size[1] - h) / 2))
+        box.append(w + box[0])
+        box.append(h + box[1])
 
     im = im.crop(tuple(box))
     return im
 
 
-def image_view_mode_2(im, w, h):
+def image_view_mode_2(im, w, h, preset=None):
     """
     限定缩略图的宽最多为<Width>，高最多为<Height>，进行等比缩放，不裁剪。
     如果只指定 w 参数则表示限定宽度（高度自适应），只指定 h 参数则表示限定高度（宽度自适应）。
@@ -190,11 +786,11 @@ def image_view_mode_2(im, w, h):
         return im
 
     resize = tuple(int(x * min_ratio) for x in size)
-    im = im.resize(resize)
+    im = resize_image(im, resize, preset)
     return im
 
 
-def image_view_mode_3(im, w, h):
+def image_view_mode_3(im, w, h, preset=None):
     """
     限定缩略图的宽最少为<Width>，高最少为<Height>，进行等比缩放，不裁剪。
     """
@@ -217,11 +813,11 @@ def image_view_mode_3(im, w, h):
         return im
 
     resize = tuple(int(x * max_ratio) for x in size)
-    im = im.resize(resize)
+    im = resize_image(im, resize, preset)
     return im
 
 
-def image_view_mode_4(im, long_edge, short_edge):
+def image_view_mode_4(im, long_edge, short_edge, preset=None):
     """
     限定缩略图的长边最少为<LongEdge>，短边最少为<ShortEdge>，进行等比缩放，不裁剪。
     这个模式很适合在手持设备做图片的全屏查看（把这里的长边短边分别设为手机屏幕的分辨率即可），
@@ -249,14 +845,14 @@ def image_view_mode_4(im, long_edge, short_edge):
         return im
 
     resize = tuple(int(x * max_ratio) for x in size)
-    im = im.resize(resize)
+    im = resize_image(im, resize, preset)
     return im
 
 
-def image_view_mode_5(im, long_edge, short_edge):
+def image_view_mode_5(im, long_edge, short_edge, preset=None, gravity=None, route_file=None):
     """
     限定缩略图的长边最少为<LongEdge>，短边最少为<ShortEdge>，进行等比缩放，居中裁剪。
-    同上模式4，但超出限定的矩形部分会被裁剪。
+    同上模式4，但超出限定的矩形部分会被裁剪。gravity为smart时以focal_point为中心裁剪
     """
     if not long_edge and not short_edge:
         return
@@ -284,11 +880,18 @@ def image_view_mode_5(im, long_edge, short_edge):
         return im
 
     box = []
+    point = focal_point(im, route_file) if gravity == 'smart' else None
     if max_ratio < 1:
-        size = resize = tuple(int(x * max_ratio) for x in size)
-        im = im.resize(resize)
-
-    if size[0] >= size[1]:  # 横向
+        resize = tuple(int(x * max_ratio) for x in size)
+        if point:
+            point = [point[0] * resize[0] / size[0], point[1] * resize[1] / size[1]]
+        size = resize
+        im = resize_image(im, resize, preset)
+
+    crop = (long_edge, short_edge) if size[0] >= size[1] else (short_edge, long_edge)
+    if point and crop[0] <= size[0] and crop[1] <= size[1]:
+        box = get_box(size, point, crop[0], crop[1])
+    elif size[0] >= size[1]:  # 横向
         box.append(int((size[0] - long_edge) / 2))
         box.append(int((size[1] - short_edge) / 2))
         box.append(box[0] + long_edge)
@@ -385,14 +988,134 @@ def _get_gravity_point(size, gravity):
     return point
 
 
-def image_mogr_crop(im, gravity, crop):
+def focal_proxy(source):
+    """
+    原图长边缩到约FOCAL_PROXY的代理图，宽高取FOCAL_CELL的整数倍，格子不会被边缘截断，图片转向后格子也能一一对应。
+    不改动原图本身：JPEG另开一份在解码时用draft缩小，其他超大原图走vips
+    """
+    w, h = source.size
+    cell = max(1, FOCAL_CELL)
+    scale = min(1.0, FOCAL_PROXY / max(w, h))
+    size = (max(1, int(round(w * scale / cell))) * cell, max(1, int(round(h * scale / cell))) * cell)
+    filename = getattr(source, 'filename', '')
+    if filename and source.format == 'JPEG' and getattr(source, 'tile', None):
+        with Image.open(filename) as proxy:
+            proxy.draft('RGB', size)
+            return proxy.resize(size, Image.BILINEAR)
+    if streamable(source):
+        return stream_resize(source, (0, 0, w, h), size)
+    return source.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+
+def focal_score(proxy):
+    """
+    在代理图上找焦点：每个格子的得分为 灰度熵 x (边缘强度 + 饱和度/2)，透明部分按不透明度折减；
+    高出平均分的部分平方后作为权重（离中心越远略微减分）求加权重心。重心随内容连续变化，
+    代理图的细微差异（draft解码、vips缩小、转向）不会让焦点跳到另一处
+    :return: 归一化坐标[x, y]（0~1），没有突出的内容时返回中心
+    """
+    w, h = proxy.size
+    alpha = None
+    if 'A' in proxy.getbands() or 'transparency' in proxy.info:
+        alpha = proxy.convert('RGBA').getchannel('A')
+    rgb = proxy.convert('RGB')
+    gray = rgb.convert('L')
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    # 3x3滤波在最外一圈直接沿用原像素，不是边缘
+    ImageDraw.Draw(edges).rectangle((0, 0, w - 1, h - 1), outline=0)
+    saturation = rgb.convert('HSV').getchannel('S')
+
+    cell = max(1, FOCAL_CELL)
+    cols, rows = max(1, w // cell), max(1, h // cell)
+    scores = {}
+    for r in range(rows):
+        for c in range(cols):
+            box = (c * cell, r * cell, min(w, (c + 1) * cell), min(h, (r + 1) * cell))
+            score = gray.crop(box).entropy() * (ImageStat.Stat(edges.crop(box)).mean[0] +
+                                                 ImageStat.Stat(saturation.crop(box)).mean[0] / 2)
+            if alpha is not None:
+                score *= ImageStat.Stat(alpha.crop(box)).mean[0] / 255
+            scores[(c, r)] = score
+
+    mean = sum(scores.values()) / len(scores)
+    total = x = y = 0.0
+    for (c, r), score in scores.items():
+        fx, fy = (c + 0.5) / cols, (r + 0.5) / rows
+        weight = max(0.0, score - mean) ** 2 * (1 - 0.25 * math.hypot(fx - 0.5, fy - 0.5) / math.hypot(0.5, 0.5))
+        total += weight
+        x += weight * fx
+        y += weight * fy
+    if not total:
+        return [0.5, 0.5]
+    return [x / total, y / total]
+
+
+def source_focal(source, route_file=None):
+    """
+    原图上的焦点（归一化坐标）。按原图版本记在source.json里：同一版本不论裁成什么尺寸都只打分一次，
+    原图重新上传后随衍生图一起作废
+    """
+    fingerprint = '{}x{}'.format(source.size[0], source.size[1])
+    path = source_version_path(route_file) if route_file else None
+    data = {}
+    if path:
+        try:
+            with open(path) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            data = {}
+        focal = data.get('focal') or {}
+        if focal.get('fingerprint') == fingerprint:
+            return focal['point']
+    point = focal_score(focal_proxy(source))
+    if path:
+        data['focal'] = {'fingerprint': fingerprint, 'point': point}
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as fd:
+                json.dump(data, fd)
+            os.replace(tmp, path)
+        except OSError as e:
+            print('focal point write failed: {}'.format(e))
+    return point
+
+
+def focal_point(im, route_file=None):
     """
-    图片裁剪
+    gravity/smart的裁剪中心（im当前的坐标）。GeometryPlan和刚打开的原图用原图上的焦点换算，
+    其余中间结果直接在自身上打分
+    """
+    w, h = im.size
+    if isinstance(im, GeometryPlan):
+        if not im.fusable:
+            # 已经有超出边界的裁剪，原图坐标对不上了，退回居中
+            return [w / 2, h / 2]
+        fx, fy = source_focal(im.source, route_file)
+        # 原图坐标 -> 当前区域内以中心为原点的归一化坐标 -> 方向变换 -> 当前结果坐标
+        x0, y0, x1, y1 = im.box
+        u = 2 * (fx * im.source.size[0] - x0) / (x1 - x0) - 1
+        v = 2 * (fy * im.source.size[1] - y0) / (y1 - y0) - 1
+        a, b, c, d = im.matrix
+        return [(a * u + b * v + 1) / 2 * w, (c * u + d * v + 1) / 2 * h]
+    if getattr(im, 'filename', ''):
+        fx, fy = source_focal(im, route_file)
+    else:
+        fx, fy = focal_score(focal_proxy(im))
+    return [fx * w, fy * h]
+
+
+def image_mogr_crop(im, gravity, crop, route_file=None):
+    """
+    图片裁剪，gravity为smart时以focal_point为中心
     """
     size = im.size
     if gravity:
         gravity = gravity.lower()
-    point = _get_gravity_point(size, gravity)
+    if gravity == 'smart':
+        point = focal_point(im, route_file)
+    else:
+        point = _get_gravity_point(size, gravity)
 
     if re.match(r"^([1-9][0-9]*)x$", crop):
         width = int(crop[:-1])
@@ -460,11 +1183,11 @@ def image_mogr_auto_orient(im):
         elif orientation == 4:
             im = im.transpose(Image.FLIP_TOP_BOTTOM)
         elif orientation == 5:
-            im = im.transpose(Image.ROTATE_270).transpose(Image.FLIP_LEFT_RIGHT)
+            im = im.transpose(Image.TRANSPOSE)
         elif orientation == 6:
             im = im.transpose(Image.ROTATE_270)
         elif orientation == 7:
-            im = im.transpose(Image.ROTATE_90).transpose(Image.FLIP_LEFT_RIGHT)
+            im = im.transpose(Image.TRANSVERSE)
         elif orientation == 8:
             im = im.transpose(Image.ROTATE_90)
 
@@ -474,7 +1197,282 @@ def image_mogr_auto_orient(im):
     return im
 
 
-def file_to_binary(p, type_='jpg'):
+def image_rotate(im, angle, background=None):
+    """
+    顺时针旋转angle度，画布扩大到能放下整张图，空白处用background填充（默认有透明通道的透明，其余白色）。
+    90的整数倍转成transpose，不重采样；作用在GeometryPlan上时和自动旋正合并成同一个方向变换
+    """
+    angle = float(angle) % 360
+    if angle % 90 == 0:
+        method = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}.get(int(angle))
+        return im.transpose(method) if method is not None else im
+    im = realize(im)
+    if im.mode not in ('L', 'RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.mode or 'transparency' in im.info else 'RGB')
+    fill = ImageColor.getcolor(background or ('#ffffff00' if im.mode == 'RGBA' else '#ffffff'), im.mode)
+    return im.rotate(-angle, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+
+
+def image_blur(im, radius, sigma=0):
+    """
+    高斯模糊。radius为模糊半径[1,50]，sigma为标准差[0,50]，0时取radius/3。
+    sigma较大时先缩小factor倍，在小图上做sigma/factor的模糊再放大回原尺寸，耗时基本不随半径增长
+    """
+    radius = min(max(int(radius), 1), 50)
+    sigma = min(float(sigma or 0) or radius / 3.0, radius, 50)
+    im = realize(im)
+    if im.mode not in ('L', 'RGB', 'RGBA', 'CMYK'):
+        im = im.convert('RGBA' if 'A' in im.mode or 'transparency' in im.info else 'RGB')
+    # 带透明通道的按预乘alpha处理，透明区域的颜色不会晕到边缘上
+    work = im.convert('RGBa') if im.mode == 'RGBA' else im
+    factor = int(sigma / BLUR_FAST_SIGMA) if BLUR_FAST_SIGMA else 1
+    factor = max(1, min(factor, min(im.size) // 8))
+    if factor > 1:
+        work = work.reduce(factor).filter(ImageFilter.GaussianBlur(sigma / factor)).resize(im.size, Image.BICUBIC)
+    else:
+        work = work.filter(ImageFilter.GaussianBlur(sigma))
+    return work.convert('RGBA') if work.mode == 'RGBa' else work
+
+
+WATERMARK_OVERLAYS = collections.OrderedDict()
+WATERMARK_OVERLAYS_LOCK = threading.Lock()
+
+
+def b64_param(value):
+    """
+    URL安全的base64参数（可以省略末尾的=）
+    """
+    value = str(value or '')
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode('utf-8')
+
+
+def watermark_font(name, size):
+    """
+    在WATERMARK_FONT_DIR下按名字找字体，找不到用WATERMARK_FONT，都没有时用PIL自带的点阵字体
+    """
+    candidates = []
+    if name:
+        name = os.path.basename(name)
+        candidates += [os.path.join(WATERMARK_FONT_DIR, name + ext) for ext in ('', '.ttf', '.ttc', '.otf')]
+    candidates.append(WATERMARK_FONT)
+    for path in candidates:
+        if os.path.isfile(path):
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                pass
+    return ImageFont.load_default()
+
+
+def cached_overlay(key, render):
+    """
+    已渲染的水印层按(内容, 尺寸, 透明度)缓存在进程内，命中时不再渲染
+    """
+    with WATERMARK_OVERLAYS_LOCK:
+        overlay = WATERMARK_OVERLAYS.pop(key, None)
+        if overlay is not None:
+            WATERMARK_OVERLAYS[key] = overlay
+            return overlay
+    overlay = render()
+    with WATERMARK_OVERLAYS_LOCK:
+        WATERMARK_OVERLAYS[key] = overlay
+        while len(WATERMARK_OVERLAYS) > WATERMARK_CACHE_SIZE:
+            WATERMARK_OVERLAYS.popitem(last=False)
+    return overlay
+
+
+def text_overlay(text, font, size, fill, opacity):
+    """
+    文字水印层：RGBA，大小正好包住文字，透明度已经乘进alpha
+    """
+    def render():
+        f = watermark_font(font, size)
+        box = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=f)
+        layer = Image.new('RGBA', (max(1, box[2] - box[0]), max(1, box[3] - box[1])), fill + (0,))
+        ImageDraw.Draw(layer).text((-box[0], -box[1]), text, font=f, fill=fill + (int(255 * opacity / 100),))
+        return layer
+
+    return cached_overlay(('text', text, font, size, fill, opacity), render)
+
+
+def fetch_overlay(name):
+    """
+    下载水印图到DERIVATIVE_DIR/overlays下，按完整对象名取key：
+    不占用原图在当前目录下的文件名，也不触发原图的版本同步和衍生图作废
+    :return: 本地路径
+    """
+    d = os.path.join(DERIVATIVE_DIR, 'overlays')
+    os.makedirs(d, exist_ok=True)
+    path = os.path.join(d, source_key(name) + os.path.splitext(name)[1])
+    try:
+        download_blob(os.getenv('BUCKET_NAME'), name, g.get('deadline'), path)
+    except Exception:
+        raise ValueError('watermark image err')
+    return path
+
+
+def image_overlay(name, short_edge, opacity):
+    """
+    图片水印层：从源站取水印图，按短边缩放到short_edge（0为原尺寸），透明度乘进alpha。
+    同名水印图在缓存淘汰前不会重新下载，更换水印请使用新的文件名
+    """
+    def render():
+        try:
+            with open_source(fetch_overlay(name)) as layer:
+                layer = layer.convert('RGBA')
+        except (OSError, Image.DecompressionBombError):
+            raise ValueError('watermark image err')
+        if short_edge and short_edge != min(layer.size):
+            scale = short_edge / min(layer.size)
+            layer = resize_image(layer, (layer.size[0] * scale, layer.size[1] * scale))
+        if opacity < 100:
+            layer.putalpha(layer.getchannel('A').point(lambda a: a * opacity // 100))
+        return layer
+
+    return cached_overlay(('image', name, short_edge, opacity), render)
+
+
+def composite_overlay(base, overlay, box):
+    """
+    只在box区域内把overlay叠加到base上，不复制整张图
+    """
+    if base.mode not in ('RGB', 'RGBA', 'L'):
+        base = base.convert('RGBA' if 'A' in base.mode or 'transparency' in base.info else 'RGB')
+    w, h = box[2] - box[0], box[3] - box[1]
+    if overlay.size != (w, h):
+        overlay = overlay.crop((0, 0, w, h))
+    if base.mode == 'RGBA':
+        base.alpha_composite(overlay, dest=(box[0], box[1]))
+    else:
+        base.paste(overlay.convert(base.mode), (box[0], box[1]), overlay)
+    return base
+
+
+def apply_watermark(im, overlay, gravity, dx=10, dy=10):
+    """
+    按gravity把水印层放到图片上，dx、dy是到最近边缘的距离
+    """
+    base = realize(im)
+    if isinstance(im, GeometryPlan) and base is im.source:
+        # 没有几何变换时realize直接返回原图对象，它可能被其他衍生图共用，不能原地修改
+        base = base.copy()
+    size = base.size
+    # _get_gravity_point取的是三等分点，按1.5倍尺寸取点正好落在边缘和中线上，再由get_box收进图片范围
+    point = _get_gravity_point((size[0] * 3 / 2, size[1] * 3 / 2), gravity)
+    sx = -1 if gravity in ('northeast', 'east', 'southeast') else 1
+    sy = -1 if gravity in ('southwest', 'south', 'southeast') else 1
+    box = get_box(size, point, overlay.size[0], overlay.size[1], sx * dx, sy * dy)
+    w, h = box[2] - box[0], box[3] - box[1]
+    x = min(max(box[0], 0), size[0] - w)
+    y = min(max(box[1], 0), size[1] - h)
+    return composite_overlay(base, overlay, (x, y, x + w, y + h))
+
+
+def image_watermark(im, d):
+    """
+    watermark/1/image/<base64图片地址>/dissolve/<透明度>/gravity/<位置>/dx/<边距>/dy/<边距>/ws/<短边比例>
+    watermark/2/text/<base64文字>/font/<base64字体名>/fontsize/<缇>/fill/<base64颜色>/dissolve/gravity/dx/dy
+    """
+    mode = str(qs_first(d, 'mode'))
+    opacity = min(100, max(0, int(qs_first(d, 'dissolve') or 100)))
+    gravity = (qs_first(d, 'gravity') or 'SouthEast').lower()
+    dx = int(qs_first(d, 'dx') or 10)
+    dy = int(qs_first(d, 'dy') or 10)
+    if mode == '1':
+        name = b64_param(qs_first(d, 'image'))
+        if re.match(r'^https?://', name):
+            name = urlparse(name).path
+        name = name.lstrip('/')
+        if not name:
+            raise ValueError('watermark image err')
+        ws = float(qs_first(d, 'ws') or 0)
+        overlay = image_overlay(name, int(min(im.size) * ws) if 0 < ws <= 1 else 0, opacity)
+    elif mode == '2':
+        text = b64_param(qs_first(d, 'text'))
+        if not text:
+            raise ValueError('watermark text err')
+        font = b64_param(qs_first(d, 'font')) if qs_first(d, 'font') else None
+        # fontsize单位是缇(1/20磅)，默认240即12磅，按96dpi换算成像素
+        size = max(1, int(int(qs_first(d, 'fontsize') or 240) / 20 * 4 / 3))
+        fill = ImageColor.getrgb(b64_param(qs_first(d, 'fill')) if qs_first(d, 'fill') else '#000000')[:3]
+        overlay = text_overlay(text, font, size, fill, opacity)
+    else:
+        raise ValueError('watermark mode err')
+    return apply_watermark(im, overlay, gravity, dx, dy)
+
+
+def can_encode(type_):
+    """
+    本机PIL是否能编码该格式（avif需要Pillow>=11.3或pillow-avif-plugin）
+    """
+    Image.init()
+    return type_.upper() in Image.SAVE
+
+
+def negotiate_format(default):
+    """
+    format/auto：按Accept头挑选客户端明确声明支持、且本机能编码的最优格式。
+    */* 这类通配不算支持，未命中时返回default
+    """
+    vary_on('Accept')
+    accepted = dict((mime.lower(), q) for mime, q in request.accept_mimetypes)
+    for type_ in AUTO_FORMATS:
+        if accepted.get('image/' + type_, 0) > 0 and can_encode(type_):
+            return type_
+    return default
+
+
+def vary_on(*headers):
+    """
+    记录本次响应依赖的请求头，由file_to_binary写入Vary
+    """
+    vary = g.setdefault('vary', [])
+    for header in headers:
+        if header not in vary:
+            vary.append(header)
+
+
+def header_number(*names):
+    """
+    按顺序取第一个能解析成数字的请求头，并记入Vary
+    """
+    vary_on(*names)
+    for name in names:
+        try:
+            return float(request.headers[name])
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+def hint_width():
+    """
+    宽度auto：按Client Hints算出需要的像素宽度，向上取到HINT_WIDTHS里的一档
+    """
+    g.accept_ch = True
+    # 不管这次用到了哪个提示，结果都取决于全部这些请求头
+    vary_on('Sec-CH-DPR', 'DPR', 'Sec-CH-Width', 'Width', 'Sec-CH-Viewport-Width', 'Viewport-Width')
+    dpr = header_number('Sec-CH-DPR', 'DPR') or 1.0
+    scale = min(max(dpr, 1.0), HINT_MAX_DPR)
+    width = header_number('Sec-CH-Width', 'Width')
+    if width:
+        # Width已经是物理像素，DPR超过上限时按比例缩回来
+        width = width / dpr * scale
+    else:
+        viewport = header_number('Sec-CH-Viewport-Width', 'Viewport-Width')
+        width = viewport * scale if viewport else HINT_DEFAULT_WIDTH
+    for bucket in HINT_WIDTHS:
+        if bucket >= width:
+            return bucket
+    return HINT_WIDTHS[-1]
+
+
+def save_data():
+    vary_on('Save-Data')
+    return request.headers.get('Save-Data', '').strip().lower() == 'on'
+
+
+def file_to_binary(p, type_='jpg', policy='derivative', source=None):
     if not type_:
         type_ = 'jpg'
     type_ = type_.lower()
@@ -492,8 +1490,11 @@ def file_to_binary(p, type_='jpg'):
     response.headers['Content-Type'] = 'image' + '/' + str(type_)
     response.headers['Content-Disposition'] = 'inline'
     response.headers['Accept-Ranges'] = 'bytes'
-    response.cache_control.max_age = 86400
-    response.cache_control.public = True
+    for header in g.get('vary', []):
+        response.vary.add(header)
+    if g.get('accept_ch'):
+        response.headers['Accept-CH'] = ACCEPT_CH
+    apply_cache_policy(response, policy, source)
     try:
         a = 'response.txt'
         with open('response.txt', 'a') as f:
@@ -503,6 +1504,33 @@ def file_to_binary(p, type_='jpg'):
     return response
 
 
+def surrogate_key(route_file):
+    return 'src-' + source_key(route_file)
+
+
+def apply_cache_policy(response, policy, source=None):
+    """
+    按CACHE_POLICIES设置Cache-Control
+    :param source: 响应所属的原图，给出时带上代理缓存标签
+    """
+    rule = CACHE_POLICIES.get(policy) or CACHE_POLICIES['derivative']
+    # send_file默认带no-cache，CDN每次都会回源验证，这里以策略里的max-age为准
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = rule.get('max_age', 86400)
+    if rule.get('s_maxage') is not None:
+        response.cache_control.s_maxage = rule['s_maxage']
+    for name in ('stale_while_revalidate', 'stale_if_error'):
+        if rule.get(name):
+            response.cache_control[name.replace('_', '-')] = str(rule[name])
+    if rule.get('immutable'):
+        # 地址对应的内容不会再变（如瓦片），不需要再验证
+        response.cache_control.immutable = True
+    if source and SURROGATE_KEY_HEADER:
+        response.headers[SURROGATE_KEY_HEADER] = surrogate_key(source)
+    return response
+
+
 def partial_response(path, start, end=None):
     file_size = os.path.getsize(path)
 
@@ -543,16 +1571,18 @@ def get_range(request):
 
 
 # 处理格式转换
-def convert_do(file_name, type_, im):
+def convert_do(file_name, type_, im, **kwargs):
     if type_ == 'jpg':
         type_ = 'jpeg'
     suffix = re.findall(r'\.[^.\\/:*?"<>|\r\n]+$', file_name)[0][1:]
     file_k = os.getcwd() + '/' + 'convert3_' + file_name.split(suffix)[0] + type_
-    im.save(file_k, type_)
+    save_image(im, file_k, type_, **kwargs)
     return file_k
 
 
 def toheic(filename):
+    import pyvips
+
     i = pyvips.Image.new_from_file(filename)
     suffix = re.findall(r'\.[^.\\/:*?"<>|\r\n]+$', filename)[0][1:]
     file_k = filename.split(suffix)[0] + 'heic'
@@ -560,18 +1590,626 @@ def toheic(filename):
     return file_k
 
 
-def download_blob(bucket_name, source_blob_name):
-    """Downloads a blob from the bucket."""
-    file_name = re.split('/', source_blob_name)[-1]
-    destination_file_name = os.getcwd() + '/' + file_name
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
+def pil_to_vips(im):
+    """
+    PIL图片直接转成pyvips图片（内存拷贝，不落盘）
+    """
+    import pyvips
+
+    if im.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        if im.mode in ('PA', 'RGBa', 'La') or 'transparency' in im.info:
+            im = im.convert('RGBA')
+        else:
+            im = im.convert('RGB')
+    return pyvips.Image.new_from_memory(im.tobytes(), im.size[0], im.size[1], len(im.getbands()), 'uchar')
+
+
+def heic_save(im, file_k, quality=None, effort=None, lossless=None):
+    """
+    heic/heif编码：像素直接从内存交给libheif，编码结果一次写到file_k
+    :param quality: 1-100，默认HEIC_QUALITY
+    :param effort: 编码耗时/压缩率取舍，0最快，9最慢
+    :param lossless: 无损编码
+    """
+    if quality is None:
+        quality = HEIC_QUALITY
+    if effort is None:
+        effort = HEIC_EFFORT
+    if lossless is None:
+        lossless = HEIC_LOSSLESS
+    options = {'Q': int(quality), 'lossless': bool(lossless)}
+    if effort is not None:
+        options['effort'] = int(effort)
+    buf = pil_to_vips(im).heifsave_buffer(**options)
+    # 和save_image一样先写临时文件再改名，写失败时不留下临时文件
+    tmp = file_k + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        with open(tmp, 'wb') as fd:
+            fd.write(buf)
+        os.replace(tmp, file_k)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return file_k
+
+
+def encoder_options(im, type_, quality=None, interlace=None, strip=None, profile=None):
+    """
+    按编码预设生成PIL save参数，再用请求里的quality/interlace/strip覆盖
+    :param interlace: jpeg对应渐进式，gif对应隔行
+    :param strip: 为True时强制去掉EXIF/ICC，否则按预设
+    """
+    type_ = (type_ or im.format or '').lower()
+    if type_ == 'jpg':
+        type_ = 'jpeg'
+    if type_ == 'heif':
+        type_ = 'heic'
+    preset = ENCODER_PROFILES.get(profile or ENCODER_PROFILE) or ENCODER_PROFILES['default']
+    options = dict(preset.get(type_, {}))
+    if quality is not None:
+        options['quality'] = int(quality)
+    if interlace is not None:
+        if type_ == 'jpeg':
+            options['progressive'] = bool(interlace)
+        elif type_ == 'gif':
+            options['interlace'] = bool(interlace)
+
+    if strip or preset.get('strip', True):
+        im.info.pop('exif', None)
+        im.info.pop('icc_profile', None)
+    else:
+        if im.info.get('exif'):
+            options['exif'] = im.info['exif']
+        if im.info.get('icc_profile'):
+            options['icc_profile'] = im.info['icc_profile']
+    return options
+
+
+def save_image(im, file_k, type_=None, quality=None, interlace=None, strip=None, profile=None, **kwargs):
+    """
+    统一的编码出口
+    """
+    im = realize(im)
+    options = encoder_options(im, type_, quality, interlace, strip, profile)
+    if type_ and type_.lower() in ('heic', 'heif'):
+        return heic_save(im, file_k, options.get('quality'), options.get('effort'), options.get('lossless'))
+    options.update(kwargs)
+    if not type_:
+        type_ = Image.registered_extensions().get(os.path.splitext(file_k)[1].lower())
+    # 先写临时文件再改名，并发读到的不会是写了一半的文件
+    tmp = file_k + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        im.save(tmp, type_, **options)
+        os.replace(tmp, file_k)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return file_k
+
+
+def source_key(route_file):
+    return hashlib.sha1(route_file.encode('utf-8')).hexdigest()
+
+
+def derivative_path(route_file, action, type_):
+    """
+    衍生图在本地存储中的路径，同一原图的所有衍生图放在同一个目录下
+    """
+    d = os.path.join(DERIVATIVE_DIR, source_key(route_file))
+    if not os.path.isdir(d):
+        os.makedirs(d, exist_ok=True)
+    return os.path.join(d, hashlib.sha1(action.encode('utf-8')).hexdigest() + '.' + type_.lower())
+
+
+def find_derivative(route_file, action):
+    """
+    已经生成过的衍生图，返回(路径, 格式)，没有则返回None
+    """
+    prefix = hashlib.sha1(action.encode('utf-8')).hexdigest() + '.'
+    d = os.path.join(DERIVATIVE_DIR, source_key(route_file))
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return None
+    for name in names:
+        if name.startswith(prefix) and not name.endswith('.tmp'):
+            if not revalidate_source(route_file):
+                return None
+            return os.path.join(d, name), name[len(prefix):]
+    return None
+
+
+def source_version_path(route_file):
+    return os.path.join(DERIVATIVE_DIR, source_key(route_file), 'source.json')
+
 
-    blob.download_to_filename(destination_file_name)
+def sync_source_version(route_file, version):
+    """
+    记录生成衍生图时的原图版本；版本变了（原图被重新上传）就清掉这张原图的全部衍生图
+    :return: 已有的衍生图是否仍然有效
+    """
+    path = source_version_path(route_file)
+    try:
+        with open(path) as fd:
+            current = json.load(fd).get('version')
+    except (OSError, ValueError):
+        current = None
+    if current == version:
+        # mtime记录最近一次确认的时间
+        os.utime(path)
+        return True
+    if current is not None:
+        drop_derivatives(route_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp, 'w') as fd:
+        json.dump({'version': version}, fd)
+    os.replace(tmp, path)
+    return current is None
+
+
+def drop_derivatives(route_file):
+    """
+    清掉一张原图在本地的衍生结果：衍生图、磁盘上的金字塔、内存里的瓦片金字塔
+    """
+    shutil.rmtree(os.path.join(DERIVATIVE_DIR, source_key(route_file)), ignore_errors=True)
+    with TILE_LEVELS_LOCK:
+        TILE_LEVELS.pop(route_file, None)
+
+
+REVALIDATING = set()
+REVALIDATING_LOCK = threading.Lock()
+
+
+def revalidate_source(route_file):
+    """
+    衍生图命中时检查原图版本：上次确认超过DERIVATIVE_REVALIDATE秒就在后台重新读GCS元数据，
+    这次请求照常返回已有的衍生图（stale-while-revalidate）
+    :return: 已有的衍生图是否可以返回
+    """
+    if DERIVATIVE_REVALIDATE <= 0:
+        return True
+    try:
+        checked = os.path.getmtime(source_version_path(route_file))
+    except OSError:
+        checked = 0
+    if time.time() - checked < DERIVATIVE_REVALIDATE:
+        return True
+    with REVALIDATING_LOCK:
+        if route_file in REVALIDATING:
+            return True
+        REVALIDATING.add(route_file)
+    threading.Thread(target=revalidate_in_background, args=(route_file,), daemon=True).start()
+    return True
+
+
+def revalidate_in_background(route_file):
+    try:
+        bucket = storage_client().bucket(os.getenv('BUCKET_NAME'))
+        blob = with_retries(lambda timeout: bucket.get_blob(route_file, timeout=timeout, retry=None),
+                            time.time() + REQUEST_DEADLINE)
+        if blob is None:
+            drop_derivatives(route_file)
+        else:
+            sync_source_version(route_file, str(blob.generation))
+    except Exception as e:
+        print('revalidate {} failed: {}'.format(route_file, e))
+    finally:
+        with REVALIDATING_LOCK:
+            REVALIDATING.discard(route_file)
+
+
+NEGATIVE_CACHE = collections.OrderedDict()
+NEGATIVE_CACHE_LOCK = threading.Lock()
+
+
+def failure_response(status, message, route_file=None):
+    return apply_cache_policy(make_response(message, status), 'negative', route_file)
+
+
+def remember_failure(route_file, status, message):
+    """
+    记入负缓存并返回对应的错误响应
+    """
+    if NEGATIVE_TTL > 0:
+        with NEGATIVE_CACHE_LOCK:
+            NEGATIVE_CACHE.pop(route_file, None)
+            NEGATIVE_CACHE[route_file] = (time.time() + NEGATIVE_TTL, status, message)
+            while len(NEGATIVE_CACHE) > NEGATIVE_CACHE_SIZE:
+                NEGATIVE_CACHE.popitem(last=False)
+    return failure_response(status, message, route_file)
+
+
+def fetch_source(route_file):
+    """
+    下载原图；不存在的对象记入负缓存，TTL内的重复请求不再访问GCS
+    :return: 失败时返回可以直接交给客户端的响应，成功返回None
+    """
+    failure = NEGATIVE_CACHE.get(route_file)
+    if failure and failure[0] > time.time():
+        return failure_response(failure[1], failure[2], route_file)
+    try:
+        generation = download_blob(os.getenv('BUCKET_NAME'), route_file, g.get('deadline'))
+    except FileNotFoundError:
+        return remember_failure(route_file, 404, 'not found')
+    except TimeoutError:
+        response = make_response('deadline exceeded', 504)
+        response.cache_control.no_store = True
+        return response
+    except:
+        # 源站临时故障不缓存
+        response = make_response('downloadFail', 502)
+        response.cache_control.no_store = True
+        return response
+    # 原图被重新上传过时，旧的衍生图在这里作废
+    sync_source_version(route_file, str(generation))
+    return None
+
+
+STORAGE_CLIENT = None
+
+
+def storage_client():
+    """
+    进程内共用一个storage.Client，复用连接和认证
+    """
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
+
+
+ORIGIN_LATENCIES = collections.deque(maxlen=200)
+
+
+def transient_error(e):
+    """
+    超时、连接错误、408/429/5xx可以重试；不存在、无权限等不重试
+    """
+    if isinstance(e, FileNotFoundError):
+        return False
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        return code in (408, 429) or code >= 500
+    return isinstance(e, (OSError, ConnectionError)) or 'Timeout' in type(e).__name__
+
+
+def with_retries(call, deadline):
+    """
+    call(timeout)，每次尝试的超时不超过ORIGIN_TIMEOUT和剩余时间；可重试的错误按指数退避加随机抖动重试，
+    截止时间前来不及再试就放弃
+    """
+    attempt = 0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError('origin deadline exceeded')
+        try:
+            return call(min(ORIGIN_TIMEOUT, remaining))
+        except Exception as e:
+            if attempt >= ORIGIN_RETRIES or not transient_error(e):
+                raise
+            pause = random.uniform(0, ORIGIN_BACKOFF * 2 ** attempt)
+            if time.time() + pause >= deadline:
+                raise
+            time.sleep(pause)
+            attempt += 1
+
+
+def hedge_delay():
+    """
+    近期单流下载耗时的p95，作为发出对冲请求前的等待时间
+    """
+    samples = sorted(ORIGIN_LATENCIES)
+    if len(samples) < 20:
+        return ORIGIN_HEDGE_DELAY
+    return max(ORIGIN_HEDGE_MIN, samples[int(len(samples) * 0.95)])
+
+
+def origin_connection(deadline):
+    """
+    占用一个DOWNLOAD_CONNECTIONS名额，最多等到deadline，来不及抛TimeoutError；用完需要release
+    """
+    if not DOWNLOAD_CONNECTIONS.acquire(timeout=max(0, deadline - time.time())):
+        raise TimeoutError('origin deadline exceeded')
+
+
+def until_deadline(call, deadline):
+    """
+    在后台线程里执行call()，最多等到deadline。超时抛TimeoutError，call在后台自行结束
+    """
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        return pool.submit(call).result(timeout=max(0, deadline - time.time()))
+    except concurrent.futures.TimeoutError:
+        raise TimeoutError('origin deadline exceeded')
+    finally:
+        pool.shutdown(wait=False)
+
+
+def hedged_download(blob, path, deadline):
+    """
+    单流下载到path，最多等到deadline。ORIGIN_HEDGE开启时，等待hedge_delay()后还没完成就再发一个相同的请求，
+    用先成功的那个；每个请求各写各的临时文件，没被采用的（包括超时后才结束的）结束后自行删除
+    """
+    def fetch(target):
+        begin = time.time()
+        origin_connection(deadline)
+        try:
+            with_retries(lambda timeout: blob.download_to_filename(target, timeout=timeout, retry=None), deadline)
+        finally:
+            DOWNLOAD_CONNECTIONS.release()
+        ORIGIN_LATENCIES.append(time.time() - begin)
+
+    def cleanup(target):
+        if os.path.exists(target):
+            os.remove(target)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    futures = {pool.submit(fetch, path + '.0'): path + '.0'}
+    winner, error = None, None
+    try:
+        delay = hedge_delay()
+        if ORIGIN_HEDGE and time.time() + delay < deadline:
+            done, _ = concurrent.futures.wait(list(futures), timeout=delay)
+            if not done:
+                futures[pool.submit(fetch, path + '.1')] = path + '.1'
+        try:
+            for future in concurrent.futures.as_completed(list(futures), timeout=max(0, deadline - time.time())):
+                try:
+                    future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                winner = future
+                break
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError('origin deadline exceeded')
+        if winner is None:
+            raise error
+        os.replace(futures[winner], path)
+    finally:
+        for future, target in futures.items():
+            if future is not winner:
+                future.add_done_callback(lambda f, target=target: cleanup(target))
+        pool.shutdown(wait=False)
+
+
+def download_ranges(blob, path, deadline):
+    """
+    按DOWNLOAD_CHUNK切段并发Range读取，每段直接写到文件里对应的偏移；
+    blob带着generation，所有分段读到的是同一个版本。每段单独重试，共用同一个截止时间。
+    超时或出错时不等还在读的分段：它们结束后丢弃数据，不再写文件
+    """
+    ranges = [(start, min(start + DOWNLOAD_CHUNK, blob.size) - 1) for start in range(0, blob.size, DOWNLOAD_CHUNK)]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    # 关闭fd和写入互斥：fd关闭后编号可能被别的文件复用，迟到的分段不能再写
+    lock = threading.Lock()
+    state = {'open': True}
+
+    def fetch(start, end):
+        origin_connection(deadline)
+        try:
+            data = with_retries(lambda timeout: blob.download_as_bytes(start=start, end=end, timeout=timeout,
+                                                                       retry=None), deadline)
+        finally:
+            DOWNLOAD_CONNECTIONS.release()
+        if len(data) != end - start + 1:
+            raise IOError('range {}-{} short read: {}'.format(start, end, len(data)))
+        with lock:
+            if state['open']:
+                os.pwrite(fd, data, start)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    futures = []
+    try:
+        os.ftruncate(fd, blob.size)
+        futures = [pool.submit(fetch, start, end) for start, end in ranges]
+        try:
+            for future in futures:
+                future.result(timeout=max(0, deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError('origin deadline exceeded')
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+        with lock:
+            state['open'] = False
+            os.close(fd)
+
+
+def download_blob(bucket_name, source_blob_name, deadline=None, destination_file_name=None):
+    """Downloads a blob from the bucket.
+
+    :param deadline: 截止时间（time.time()），默认从现在起REQUEST_DEADLINE秒；超过时抛TimeoutError
+    :param destination_file_name: 本地路径，默认为当前目录下的同名文件
+    :return: 对象的generation
+    """
+    if deadline is None:
+        deadline = time.time() + REQUEST_DEADLINE
+    if destination_file_name is None:
+        file_name = re.split('/', source_blob_name)[-1]
+        destination_file_name = os.getcwd() + '/' + file_name
+    bucket = storage_client().bucket(bucket_name)
+    blob = until_deadline(lambda: with_retries(
+        lambda timeout: bucket.get_blob(source_blob_name, timeout=timeout, retry=None), deadline), deadline)
+    if blob is None:
+        raise FileNotFoundError(source_blob_name)
+
+    # 先写临时文件再替换，并发请求不会读到写了一半的原图
+    tmp = '{}.{}.tmp'.format(destination_file_name, uuid.uuid4().hex)
+    try:
+        if blob.size is None or blob.size < DOWNLOAD_PARALLEL_MIN or blob.content_encoding == 'gzip':
+            hedged_download(blob, tmp, deadline)
+        else:
+            download_ranges(blob, tmp, deadline)
+        os.replace(tmp, destination_file_name)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
     print('Blob {} downloaded to {}.'.format(
         source_blob_name,
         destination_file_name))
+    return blob.generation
+
+
+def request_plan():
+    """
+    当前请求的操作计划，附在profile产物里
+    """
+    return [parse_qs(k) for k in request.args if re.findall(r'imageView2', k) or re.findall(r'imageMogr2', k)]
+
+
+class StackSampler(object):
+    """
+    采样式profiler：后台线程按固定间隔抓取目标线程的调用栈，
+    结果为flamegraph.pl / speedscope可直接读取的折叠栈格式（a;b;c 次数）
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def folded(self):
+        return '\n'.join('{} {}'.format(k, v) for k, v in sorted(self.stacks.items())) + '\n'
+
+
+def profile_requested():
+    """
+    请求头X-Image-Profile或参数x-profile与PROFILE_TOKEN一致时才开启profiling
+    """
+    if not PROFILE_TOKEN:
+        return False
+    token = request.headers.get('X-Image-Profile') or request.args.get('x-profile')
+    return bool(token) and hmac.compare_digest(str(token), PROFILE_TOKEN)
+
+
+def prune_profiles(keep=PROFILE_KEEP):
+    """
+    按修改时间只保留最新的keep个profile（同一id的.folded/.pstats/.json一起删除）
+    """
+    latest = {}
+    for n in os.listdir(PROFILE_DIR):
+        try:
+            mtime = os.path.getmtime(os.path.join(PROFILE_DIR, n))
+        except OSError:
+            continue
+        profile_id = n.split('.', 1)[0]
+        latest[profile_id] = max(latest.get(profile_id, 0), mtime)
+    stale = set(sorted(latest, key=latest.get, reverse=True)[max(keep, 0):])
+    for n in os.listdir(PROFILE_DIR):
+        if n.split('.', 1)[0] in stale:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, n))
+            except OSError:
+                pass
+
+
+def profile_request(f, *args, **kwargs):
+    """
+    在profiler下执行一次请求，产物写入PROFILE_DIR：
+    <id>.folded（采样）或<id>.pstats（cProfile），以及附带操作计划的<id>.json
+    """
+    profile_id = uuid.uuid4().hex
+    mode = request.headers.get('X-Image-Profile-Mode') or request.args.get('x-profile-mode') or 'sample'
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    prune_profiles(PROFILE_KEEP - 1)
+    base = os.path.join(PROFILE_DIR, profile_id)
+
+    start = time.time()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        rv = profiler.runcall(f, *args, **kwargs)
+        profiler.dump_stats(base + '.pstats')
+        artifact = base + '.pstats'
+    else:
+        sampler = StackSampler(threading.current_thread().ident)
+        sampler.start()
+        try:
+            rv = f(*args, **kwargs)
+        finally:
+            sampler.stop()
+        with open(base + '.folded', 'w') as fd:
+            fd.write(sampler.folded())
+        artifact = base + '.folded'
+    elapsed = time.time() - start
+
+    response = make_response(rv)
+    with open(base + '.json', 'w') as fd:
+        json.dump({
+            'id': profile_id,
+            'mode': mode,
+            'path': request.path,
+            'query': request.query_string.decode('utf-8', 'replace'),
+            'plan': request_plan(),
+            'status': response.status_code,
+            'elapsed': elapsed,
+            'artifact': os.path.basename(artifact),
+        }, fd, ensure_ascii=False, indent=2)
+    # 带profile的响应和正常结果不同（计时头等），覆盖原有缓存策略，不能进CDN和浏览器缓存
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Profile-Id'] = profile_id
+    response.headers['X-Profile-Elapsed'] = '%.6f' % elapsed
+    return response
+
+
+def profiled(f):
+    """
+    视图装饰器：未开启profiling的请求直接调用原函数，不做任何额外工作
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not profile_requested():
+            return f(*args, **kwargs)
+        return profile_request(f, *args, **kwargs)
+    return wrapper
+
+
+@app.route('/_profile/<profile_id>', methods=['GET'])
+def profile_artifact(profile_id):
+    """
+    下载profile产物：默认返回采样/cProfile结果，?part=plan返回附带操作计划的<id>.json
+    """
+    if not profile_requested():
+        return 'forbidden', 403
+    if not re.match(r'^[0-9a-f]{32}$', profile_id):
+        return 'not found', 404
+    if request.args.get('part') == 'plan':
+        candidates = (('.json', 'application/json'),)
+    else:
+        candidates = (('.folded', 'application/octet-stream'), ('.pstats', 'application/octet-stream'))
+    for ext, mimetype in candidates:
+        p = os.path.join(PROFILE_DIR, profile_id + ext)
+        if os.path.exists(p):
+            response = make_response(send_file(p, mimetype=mimetype))
+            response.cache_control.no_store = True
+            return response
+    return 'not found', 404
 
 
 @app.route('/index', methods=["GET", "POST"])
@@ -579,6 +2217,248 @@ def hello():
     return 'index'
 
 
+@app.before_request
+def start_deadline():
+    """
+    请求开始时确定截止时间，取原图和后面的处理共用这一个预算
+    """
+    g.deadline = time.time() + REQUEST_DEADLINE
+
+
+# 冷启动：master里导入时先做一次预热，预热完成前/_ready返回503
+WARM_UP = os.getenv('WARM_UP', '1') == '1'
+WARM_UP_FORMATS = [t for t in os.getenv('WARM_UP_FORMATS', 'jpeg,png,webp').split(',') if t]
+PROCESS_STARTED = time.time()
+READY = threading.Event()
+STARTUP = {'warm_up_seconds': None, 'first_good_request_seconds': None}
+
+
+def warm_up():
+    """
+    合成一张JPEG走一遍 解码→缩放→编码，提前加载PIL插件、编码器和缩放路径
+    gunicorn preload_app时在master里执行，fork出来的worker直接继承
+    """
+    begin = time.time()
+    try:
+        buf = io.BytesIO()
+        Image.new('RGB', (640, 480), (128, 128, 128)).save(buf, 'JPEG')
+        buf.seek(0)
+        im = realize(resize_image(plan_geometry(Image.open(buf)), (160, 120)))
+        for type_ in WARM_UP_FORMATS:
+            if can_encode(type_):
+                im.save(io.BytesIO(), type_.upper(), **encoder_options(im, type_))
+    except Exception as e:
+        print('warm up failed: {}'.format(e))
+    STARTUP['warm_up_seconds'] = round(time.time() - begin, 3)
+    READY.set()
+
+
+def warm_up_worker():
+    """
+    fork之后在每个worker里执行：storage client的连接不能跨进程共用，在这里各自建立
+    """
+    try:
+        storage_client()
+    except Exception as e:
+        print('storage client failed: {}'.format(e))
+
+
+# worker常驻内存超过WORKER_MAX_RSS（MB，0为不限制）后，处理完手上的请求退出，由gunicorn master重新fork
+WORKER_MAX_RSS = int(os.getenv('WORKER_MAX_RSS', '1024')) * 1024 * 1024
+
+
+def current_rss():
+    """
+    当前进程的常驻内存（字节），取不到时返回0
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def should_recycle():
+    """
+    gunicorn的post_request里调用，判断这个worker是否该退出重建
+    """
+    return WORKER_MAX_RSS > 0 and current_rss() > WORKER_MAX_RSS
+
+
+class FairScheduler(object):
+    """
+    处理槽位的调度：按成本把任务分到lane，每个lane最多占用自己的槽位数，其余的留给别的lane。
+    排队的任务按self-clocked加权公平排队出队：同一(lane, 租户)的任务依次累加 成本/lane权重 得到完成标签，
+    在能执行的任务里标签最小的先执行，轻任务不会排在一串重任务后面，一个租户也挤不掉其他租户
+    """
+
+    def __init__(self, slots, lanes, tenant_slots=0):
+        self.slots = slots
+        self.lanes = lanes
+        self.tenant_slots = tenant_slots
+        self.cond = threading.Condition()
+        self.running = collections.Counter()
+        self.tenants = collections.Counter()
+        self.waiting = []
+        self.finish = {}
+        self.vtime = 0.0
+        self.seq = 0
+
+    def lane(self, cost):
+        for lane in self.lanes:
+            if lane.get('max_cost') is None or cost <= lane['max_cost']:
+                return lane
+        return self.lanes[-1]
+
+    def _eligible(self, entry):
+        lane, tenant = entry[2], entry[3]
+        limit = lane.get('slots') or self.slots
+        return (self.running[lane['name']] < limit and
+                (not self.tenant_slots or self.tenants[tenant] < self.tenant_slots))
+
+    def _next(self):
+        if sum(self.running.values()) >= self.slots:
+            return None
+        eligible = [entry for entry in self.waiting if self._eligible(entry)]
+        return min(eligible, key=lambda entry: entry[:2]) if eligible else None
+
+    def acquire(self, cost, tenant='', deadline=None):
+        """
+        排队直到轮到这个任务
+        :return: 占用的槽位，交给release；deadline（time.time()）之前没有轮到返回None
+        """
+        lane = self.lane(cost)
+        if self.slots <= 0:
+            return lane['name'], tenant
+        key = (lane['name'], tenant)
+        with self.cond:
+            tag = max(self.vtime, self.finish.get(key, 0.0)) + cost / max(lane.get('weight', 1), 1e-9)
+            self.finish[key] = tag
+            self.seq += 1
+            entry = [tag, self.seq, lane, tenant]
+            self.waiting.append(entry)
+            while True:
+                if self._next() is entry:
+                    self.waiting.remove(entry)
+                    self.running[lane['name']] += 1
+                    self.tenants[tenant] += 1
+                    self.vtime = max(self.vtime, tag)
+                    # 可能还有空闲槽位，让其他lane的任务也看一下
+                    self.cond.notify_all()
+                    return lane['name'], tenant
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self.waiting.remove(entry)
+                    if self.finish.get(key) == tag:
+                        self.finish[key] = tag - cost / max(lane.get('weight', 1), 1e-9)
+                    self.cond.notify_all()
+                    return None
+                self.cond.wait(remaining)
+
+    def release(self, slot):
+        if self.slots <= 0:
+            return
+        name, tenant = slot
+        with self.cond:
+            self.running[name] -= 1
+            self.tenants[tenant] -= 1
+            if not self.tenants[tenant]:
+                del self.tenants[tenant]
+            # 完成标签不超过虚拟时间的，和没有记录等价
+            if len(self.finish) > 1024:
+                self.finish = {k: v for k, v in self.finish.items() if v > self.vtime}
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return {'slots': self.slots, 'running': dict(self.running),
+                    'waiting': dict(collections.Counter(entry[2]['name'] for entry in self.waiting))}
+
+
+JOB_SCHEDULER = FairScheduler(PROCESS_SLOTS, SCHEDULER_LANES, SCHEDULER_TENANT_SLOTS)
+
+
+def job_cost(source, ops, frames=1):
+    """
+    粗略的处理成本：原图像素数 x 帧数 x (1 + 各操作权重之和)，只用到文件头里的尺寸
+    """
+    return source.size[0] * source.size[1] * max(1, frames) * (1 + sum(JOB_WEIGHTS.get(op, 0) for op in ops))
+
+
+def job_ops(k, source_format):
+    """
+    imageView2/imageMogr2参数里影响成本的操作：输出格式、模糊、旋转、水印
+    """
+    t = k.split('/')
+    type_ = t[t.index('format') + 1] if 'format' in t and t.index('format') + 1 < len(t) else source_format
+    ops = [(type_ or '').lower()]
+    if t[0] == IMAGE_MOGR:
+        ops += [name for name in ('blur', 'rotate') if name in t]
+    elif t[0] == WATER_MARK:
+        ops.append('watermark')
+    return ops
+
+
+def job_tenant(route_file):
+    if SCHEDULER_TENANT_DEPTH <= 0:
+        return ''
+    return '/'.join(route_file.split('/')[:SCHEDULER_TENANT_DEPTH])
+
+
+def schedule(cost, route_file):
+    """
+    为当前请求排队等一个处理槽位，请求结束时由release_slot归还
+    :return: 截止时间前没有轮到时返回False
+    """
+    deadline = g.get('deadline') or time.time() + REQUEST_DEADLINE
+    slot = JOB_SCHEDULER.acquire(cost, job_tenant(route_file), deadline)
+    if slot is None:
+        return False
+    g.slots = g.get('slots', []) + [slot]
+    return True
+
+
+@app.teardown_request
+def release_slot(exc=None):
+    for slot in g.pop('slots', []):
+        JOB_SCHEDULER.release(slot)
+
+
+def busy_response():
+    """
+    排队到截止时间仍没有轮到：503让客户端稍后重试，不缓存
+    """
+    response = make_response('busy', 503)
+    response.headers['Retry-After'] = '1'
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/_ready')
+def ready():
+    """
+    就绪检查：预热完成前返回503，同时带上启动耗时
+    """
+    body = dict(STARTUP, ready=READY.is_set(), uptime=round(time.time() - PROCESS_STARTED, 3), rss=current_rss(),
+                scheduler=JOB_SCHEDULER.snapshot())
+    response = make_response(json.dumps(body), 200 if READY.is_set() else 503)
+    response.headers['Content-Type'] = 'application/json'
+    response.cache_control.no_store = True
+    return response
+
+
+@app.after_request
+def record_first_good_request(response):
+    """
+    记录进程启动到第一个成功的图片响应的时间
+    """
+    if STARTUP['first_good_request_seconds'] is None and 200 <= response.status_code < 300 \
+            and request.endpoint in ('image2', 'batch', 'dzi_tile'):
+        STARTUP['first_good_request_seconds'] = round(time.time() - PROCESS_STARTED, 3)
+        print('first good request after {}s'.format(STARTUP['first_good_request_seconds']))
+    return response
+
+
 class RegexConverter(BaseConverter):
     def __init__(self, url_map, *args):
         super(RegexConverter, self).__init__(url_map)
@@ -588,86 +2468,574 @@ class RegexConverter(BaseConverter):
 app.url_map.converters['re'] = RegexConverter
 
 
-@app.route('/<re(r"[\w\W]*"):route_file>', methods=['GET', 'POST'])
-def image2(route_file):
-    request_file = re.split('/', route_file)[-1]
-    bucket_name = os.getenv('BUCKET_NAME')
-    try:
-        download_blob(bucket_name, route_file)
-    except:
-        return 'downloadFail'
-    suffix = re.findall(r'\.[^.\\/:*?"<>|\r\n]+$', request_file)[0][1:]
-    k = ''
-    for i in request.args:
-        if re.findall(r'imageView2', i) or re.findall(r'imageMogr2', i):
-            k = i
-    if not k:
-        return file_to_binary(request_file, suffix)
-    key = os.getcwd() + '/' + request_file
-    im = Image.open(key)
+def canonical_query(k):
+    """
+    等价的imageView2/imageMogr2参数写成同一个形式：参数按固定顺序排列、重复的以第一个为准（和parse_qs一致），
+    去掉不起作用的参数（没有crop的gravity、转0度、不是90整数倍时才用到的background等）。
+    不认识的写法原样返回
+    """
+    args = k.split('/')
+    if args[0] == IMAGE_VIEW:
+        if len(args) < 2 or len(args) % 2 or 'auto-orient' in args:
+            return k
+        params = {}
+        for name, value in zip(args[2::2], args[3::2]):
+            params.setdefault(name, value)
+        if 'quality' in params:
+            params['q'] = params.pop('quality')
+        # gravity只对模式1、5的smart起作用
+        gravity = params.pop('gravity', '').lower()
+        if gravity == 'smart' and args[1] in ('1', '5'):
+            params['gravity'] = gravity
+        try:
+            size = [params.pop(name, '0') or '0' for name in ('w', 'h')]
+            size = [value if value == 'auto' else str(int(value)) for value in size]
+        except ValueError:
+            return k
+        out = [IMAGE_VIEW, args[1]]
+        if args[1] in ('1', '2', '3', '4', '5'):
+            for name, value in zip(('w', 'h'), size):
+                if value != '0':
+                    out += [name, value]
+        if params.get('format') == 'jpg':
+            params['format'] = 'jpeg'
+        for name in ('format', 'interlace', 'q', 'profile', 'resample', 'strip'):
+            if name in params:
+                out += [name, params.pop(name)]
+        for name in sorted(params):
+            out += [name, params[name]]
+        return '/'.join(out)
+
+    if args[0] == IMAGE_MOGR:
+        flags = set()
+        params = {}
+        i = 1
+        while i < len(args):
+            if args[i] in ('auto-orient', 'strip'):
+                flags.add(args[i])
+                i += 1
+            elif args[i] in ('thumbnail', 'gravity', 'crop', 'rotate', 'background', 'blur', 'format', 'interlace',
+                             'quality', 'profile', 'resample') and i + 1 < len(args):
+                params.setdefault(args[i], args[i + 1])
+                i += 2
+            else:
+                return k
+        # thumbnail只解析不执行
+        params.pop('thumbnail', None)
+        if 'crop' not in params:
+            params.pop('gravity', None)
+        if 'gravity' in params:
+            params['gravity'] = params['gravity'].lower()
+        if 'rotate' in params:
+            try:
+                angle = float(params['rotate']) % 360
+            except ValueError:
+                return k
+            if angle:
+                params['rotate'] = '%g' % angle
+            else:
+                params.pop('rotate')
+            if not angle or angle % 90 == 0:
+                params.pop('background', None)
+        else:
+            params.pop('background', None)
+        if 'blur' in params:
+            radius, _, sigma = params['blur'].partition('x')
+            params['blur'] = '{}x{}'.format(radius, sigma or '0')
+        if params.get('format') == 'jpg':
+            params['format'] = 'jpeg'
+        out = [IMAGE_MOGR] + (['auto-orient'] if 'auto-orient' in flags else [])
+        for name in ('gravity', 'crop', 'rotate', 'background', 'blur', 'format', 'interlace', 'quality', 'profile',
+                     'resample'):
+            if name in params:
+                out += [name, params[name]]
+        return '/'.join(out + (['strip'] if 'strip' in flags else []))
+    return k
+
+
+def resolve_query(k, suffix):
+    """
+    把format/auto替换成协商出的格式、imageView2的w/auto替换成按Client Hints算出的宽度，
+    得到真正决定输出内容的参数串（也是衍生图的缓存key）
+    """
+    t = canonical_query(k).split('/')
+    if 'format' in t and t.index('format') + 1 < len(t) and t[t.index('format') + 1] == 'auto':
+        t[t.index('format') + 1] = negotiate_format(suffix)
+    if t[0] == IMAGE_VIEW and len(t) % 2 == 0 and 'w' in t[2::2] and t[t[2::2].index('w') * 2 + 3] == 'auto':
+        t[t[2::2].index('w') * 2 + 3] = str(hint_width())
+        if save_data():
+            if 'q' in t[2::2]:
+                i = t[2::2].index('q') * 2 + 3
+                t[i] = str(min(int(t[i]), SAVE_DATA_QUALITY)) if t[i].isdigit() else t[i]
+            else:
+                t += ['q', str(SAVE_DATA_QUALITY)]
+    return canonical_query('/'.join(t))
+
+
+def canonical_redirect(route_file, k):
+    """
+    301到处理参数为规范形式的地址，其他查询参数原样保留
+    """
+    others = [(name, value) for name, value in request.args.items(multi=True) if name != k]
+    url = request.path + '?' + quote(canonical_query(k), safe='/') + ('&' + urlencode(others) if others else '')
+    return apply_cache_policy(redirect(url, 301), 'redirect', route_file)
+
+
+def process_query(im, k, route_file=None):
+    """
+    执行imageView2/imageMogr2处理
+    :param im: 原图（或其GeometryPlan）
+    :param route_file: 原图路径，gravity/smart用它缓存焦点
+    :return: (结果图, 输出格式, save_image的编码参数)
+    """
     type_ = im.format.lower()
     d = parse_qs(k)
     if re.findall(r'auto-orient', k):
         im = image_mogr_auto_orient(im)
     if re.findall(r'format', k):
         t = k.split('/')
+        if 'format' not in t or t.index('format') + 1 >= len(t):
+            raise ValueError('format err')
         type_ = t[t.index('format') + 1]
-        if type_ == 'jpg':
-            type_ = 'jpeg'
-    key = os.getcwd() + '/' + request_file.split(suffix)[0] + type_
-    request_file = request_file.split(suffix)[0] + type_
+        # heic/heif由vips编码，不在PIL的编码器里
+        if type_ != 'jpg' and type_.lower() not in ('heic', 'heif') and not can_encode(type_):
+            raise ValueError('format err')
+    if type_ == 'jpg':
+        type_ = 'jpeg'
+    if not d:
+        return im, type_, {}
+
+    encode_args = encode_params(d)
+    preset = qs_first(d, 'resample')
     try:
         if d['interface'][0] == 'imageView2':
-            if str(d['mode'][0]) == '1':
-                im = image_view_mode_1(im, int(d['w'][0]), int(d['h'][0]))
-                file_k = os.getcwd() + '/' + 'thumbnail8_' + request_file
-                im.save(file_k, type_)
-                return file_to_binary(file_k, type_)
-            if str(d['mode'][0]) == '2':
-                im = image_view_mode_2(im, int(d['w'][0]), int(d['h'][0]))
-                file_k = os.getcwd() + '/' + 'thumbnail9_' + request_file
-                print(file_k)
-                im.save(file_k, type_)
-                return file_to_binary(file_k, type_)
-            if str(d['mode'][0]) == '3':
-                im = image_view_mode_3(im, int(d['w'][0]), int(d['h'][0]))
-                file_k = os.getcwd() + '/' + 'thumbnail0_' + request_file
-                im.save(file_k, type_)
-                return file_to_binary(file_k, type_)
-            if str(d['mode'][0]) == '4':
-                im = image_view_mode_4(im, int(d['w'][0]), int(d['h'][0]))
-                file_k = os.getcwd() + '/' + 'thumbnail11_' + request_file
-                im.save(file_k, type_)
-                return file_to_binary(file_k, type_)
-            if str(d['mode'][0]) == '5':
-                im = image_view_mode_5(im, int(d['w'][0]), int(d['h'][0]))
-                file_k = os.getcwd() + '/' + 'thumbnail12_' + request_file
-                im.save(file_k, type_)
-                return file_to_binary(file_k, type_)
-            else:
-                im.save(key, type_)
-                print(key)
-                return file_to_binary(request_file, type_)
+            modes = {'1': image_view_mode_1, '2': image_view_mode_2, '3': image_view_mode_3,
+                     '4': image_view_mode_4, '5': image_view_mode_5}
+            mode = str(d['mode'][0])
+            w = int(qs_first(d, 'w') or 0)
+            h = int(qs_first(d, 'h') or 0)
+            if mode in ('1', '5') and (w or h):
+                im = modes[mode](im, w, h, preset, (qs_first(d, 'gravity') or '').lower(), route_file)
+            elif mode in modes and (w or h):
+                im = modes[mode](im, w, h, preset)
 
         elif d['interface'] == 'imageMogr2':
             crop = d.get('crop')
             gravity = d.get('gravity')
-            type_ = d.get('format')
-            if type_:
-                if not crop and not gravity:
-                    file_k = convert_do(request_file, type_, im)
-                    return file_to_binary(file_k, type_)
-            im = image_mogr_crop(im, gravity, crop)
-            file_k = os.getcwd() + '/' + 'crop13_' + request_file
-            im.save(file_k, type_)
-            return file_to_binary(file_k, type_)
+            if crop:
+                im = image_mogr_crop(im, gravity, crop, route_file)
+            if d.get('rotate'):
+                # background/<base64颜色>
+                im = image_rotate(im, d['rotate'], b64_param(d['background']) if d.get('background') else None)
+            t = k.split('/')
+            if d.get('blur') == 'True' and t.index('blur') + 1 < len(t):
+                # blur/<radius>x<sigma>
+                radius, _, sigma = t[t.index('blur') + 1].partition('x')
+                im = image_blur(im, radius, sigma)
+        elif d['interface'][0] == WATER_MARK:
+            im = image_watermark(im, d)
         else:
-            return str(d['interface']) + ' err'
+            raise ValueError(str(d['interface']) + ' err')
     except TypeError:
-        im.save(key, type_)
-        file_k = os.getcwd() + '/' + request_file
-        return file_to_binary(file_k, type_)
+        pass
+    return im, type_, encode_args
+
+
+def render_variants(route_file, variants, inline=False):
+    """
+    对同一张原图生成多个衍生图：衍生图存储里已有的直接复用，其余的共用一次解码和同一个ImageLevels。
+    原图需要先由fetch_source下载到本地
+    :return: 每个衍生图的描述(process/url/status/format/bytes)
+    """
+    request_file = re.split('/', route_file)[-1]
+    suffix = re.findall(r'\.[^.\\/:*?"<>|\r\n]+$', request_file)[0][1:]
+    levels = None
+    busy = False
+    results = []
+    try:
+        for i, variant in enumerate(variants):
+            k = resolve_query(str(variant), suffix)
+            result = {'process': k, 'url': '/' + route_file + '?' + k}
+            cached = find_derivative(route_file, k)
+            if cached:
+                file_k, type_ = cached
+            else:
+                if levels is None and not busy:
+                    source = open_source(os.getcwd() + '/' + request_file)
+                    # 按这一批里剩下的衍生图估算成本，整批占用一个处理槽位
+                    cost = sum(job_cost(source, job_ops(str(v), source.format)) for v in variants[i:])
+                    if schedule(cost, route_file):
+                        levels = open_levels(route_file, source)
+                        # 各衍生图共用这张原图：先完整解码，不带levels的realize（圆形、旋转、水印等）
+                        # 就不会对它draft，把后面的衍生图也缩小
+                        if not streamable(source):
+                            source.load()
+                    else:
+                        source.close()
+                        busy = True
+                if busy:
+                    result.update({'status': 503, 'error': 'busy'})
+                    results.append(result)
+                    continue
+                try:
+                    im, type_, encode_args = process_query(GeometryPlan(levels.source), k, route_file)
+                    file_k = derivative_path(route_file, k, type_)
+                    save_image(realize(im, levels), file_k, type_, **encode_args)
+                except ValueError as e:
+                    result.update({'status': 400, 'error': str(e)})
+                    results.append(result)
+                    continue
+                except Image.DecompressionBombError:
+                    result.update({'status': 422, 'error': 'image too large'})
+                    results.append(result)
+                    continue
+            result.update({'status': 200, 'format': type_, 'bytes': os.path.getsize(file_k)})
+            if inline:
+                with open(file_k, 'rb') as fd:
+                    result['data'] = base64.b64encode(fd.read()).decode('ascii')
+            results.append(result)
+    finally:
+        # 原图只在这一批里用，用完立即关闭，释放文件句柄和解码后的像素
+        if levels is not None:
+            levels.source.close()
+    return results
+
+
+def srcset(route_file, k):
+    """
+    srcset/w/320,640,960/<其他imageView2参数>：一次解码按宽度阶梯生成整组响应式图片。
+    每个宽度的结果就是 imageView2/2/w/<n>/<其他参数> 的衍生图，之后这些URL直接命中衍生图存储
+    """
+    request_file = re.split('/', route_file)[-1]
+    args = k.split('/')
+    params = dict(zip(*2 * (iter(args[1:]),)))
+    widths = SRCSET_WIDTHS
+    if params.get('w'):
+        widths = [int(w) for w in params.pop('w').split(',') if w.isdigit()]
+    rest = []
+    for name in args[1::2]:
+        if name in params:
+            rest += [name, params[name]]
+
+    # 只读文件头拿尺寸；不放大，超过原图宽度的统一由原图宽度代替
+    failure = fetch_source(route_file)
+    if failure is not None:
+        return failure
+    try:
+        with open_source(os.getcwd() + '/' + request_file) as source:
+            source_width = source.size[0]
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    ladder = sorted(set(min(w, source_width) for w in widths if w > 0))
+    variants = ['/'.join([IMAGE_VIEW, '2', 'w', str(w)] + rest) for w in ladder]
+    try:
+        results = render_variants(route_file, variants)
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    except Image.DecompressionBombError:
+        return failure_response(422, 'image too large', route_file)
+
+    response = make_response(json.dumps({
+        'source': route_file,
+        'srcset': ', '.join('{} {}w'.format(r['url'], w) for w, r in zip(ladder, results) if r['status'] == 200),
+        'variants': results,
+    }))
+    response.headers['Content-Type'] = 'application/json'
+    for header in g.get('vary', []):
+        response.vary.add(header)
+    return apply_cache_policy(response, 'derivative', route_file)
+
+
+@app.route('/_batch/<path:route_file>', methods=['POST'])
+@profiled
+def batch(route_file):
+    """
+    一次下载、一次解码生成多个衍生图：
+    POST {"variants": ["imageView2/2/w/200", "imageView2/1/w/400/h/300", ...], "inline": false}
+    结果写入衍生图存储，之后用 /<route_file>?<variant> 可以直接单独访问
+    """
+    body = request.get_json(silent=True) or {}
+    variants = body.get('variants') or []
+    if not isinstance(variants, list) or not variants:
+        return 'variants err', 400
+    failure = fetch_source(route_file)
+    if failure is not None:
+        return failure
+    try:
+        results = render_variants(route_file, variants, body.get('inline'))
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    except Image.DecompressionBombError:
+        return failure_response(422, 'image too large', route_file)
+    response = make_response(json.dumps({'source': route_file, 'variants': results}))
+    response.headers['Content-Type'] = 'application/json'
+    response.cache_control.no_store = True
+    return response
+
+
+TILE_LEVELS = collections.OrderedDict()
+TILE_LEVELS_LOCK = threading.Lock()
+
+
+def tile_levels(route_file, refresh=False):
+    """
+    瓦片用的金字塔，进程内按原图缓存最近TILE_SOURCES张，同一张原图的各级只生成一次（并经LevelStore落盘）
+    :param refresh: 丢弃内存里的旧金字塔重新打开原图
+    :return: (ImageLevels, 自动旋正需要的transpose列表, 旋正后的尺寸, 锁)
+    """
+    with TILE_LEVELS_LOCK:
+        entry = None if refresh else TILE_LEVELS.pop(route_file, None)
+        if entry is None:
+            request_file = re.split('/', route_file)[-1]
+            source = open_source(os.getcwd() + '/' + request_file)
+            # 只记录旋正用的transpose，各级金字塔保持原图方向，和普通缩放共用LevelStore
+            orient = image_mogr_auto_orient(GeometryPlan(source))
+            if source.mode in ImageLevels.REDUCIBLE_MODES:
+                levels = open_levels(route_file, source)
+            else:
+                levels = ImageLevels(source.convert('RGBA' if 'transparency' in source.info else 'RGB'))
+            entry = (levels, [op[1] for op in orient.ops], orient.size, threading.Lock())
+        TILE_LEVELS[route_file] = entry
+        while len(TILE_LEVELS) > TILE_SOURCES:
+            TILE_LEVELS.popitem(last=False)
+    return entry
+
+
+def tile_format(levels, fmt=None):
+    fmt = (fmt or TILE_FORMAT).lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt == 'jpeg' and 'A' in levels.levels[1].mode:
+        fmt = 'png'
+    return fmt
+
+
+@app.route('/_dzi/<path:route_file>.dzi')
+@profiled
+def dzi(route_file):
+    """
+    Deep Zoom描述文件，尺寸为自动旋正后的尺寸
+    """
+    failure = fetch_source(route_file)
+    if failure is not None:
+        return failure
+    try:
+        levels, orientation, size, lock = tile_levels(route_file, refresh=True)
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    except Image.DecompressionBombError:
+        return failure_response(422, 'image too large', route_file)
+    response = make_response(
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{}" Overlap="{}" Format="{}">'
+        '<Size Width="{}" Height="{}"/></Image>'.format(TILE_SIZE, TILE_OVERLAP, tile_format(levels), size[0], size[1]))
+    response.headers['Content-Type'] = 'application/xml'
+    return apply_cache_policy(response, 'dzi', route_file)
+
+
+@app.route('/_dzi/<path:route_file>_files/<int:level>/<int:col>_<int:row>.<fmt>')
+@profiled
+def dzi_tile(route_file, level, col, row, fmt):
+    """
+    Deep Zoom瓦片：第level级是原图缩小2^(最大级-level)倍，按TILE_SIZE切块，相邻块重叠TILE_OVERLAP像素。
+    瓦片直接从对应一级的金字塔上裁出，结果写入衍生图存储，之后的请求直接返回
+    """
+    request_file = re.split('/', route_file)[-1]
+    key = 'dzi/{}/{}/{}/{}_{}.{}'.format(TILE_SIZE, TILE_OVERLAP, level, col, row, fmt)
+    cached = find_derivative(route_file, key)
+    if cached:
+        return file_to_binary(cached[0], cached[1], 'tile', route_file)
+    if route_file not in TILE_LEVELS or not os.path.exists(os.getcwd() + '/' + request_file):
+        failure = fetch_source(route_file)
+        if failure is not None:
+            return failure
+    try:
+        levels, orientation, size, lock = tile_levels(route_file)
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    except Image.DecompressionBombError:
+        return failure_response(422, 'image too large', route_file)
+    fmt = tile_format(levels, fmt)
+    if not can_encode(fmt):
+        return 'format err', 400
+
+    max_level = (max(size) - 1).bit_length()
+    if level > max_level:
+        return 'level err', 404
+    factor = 2 ** (max_level - level)
+    lw, lh = -(-size[0] // factor), -(-size[1] // factor)
+    x0, y0 = col * TILE_SIZE, row * TILE_SIZE
+    if x0 >= lw or y0 >= lh:
+        return 'tile err', 404
+    box = (max(0, x0 - TILE_OVERLAP), max(0, y0 - TILE_OVERLAP),
+           min(lw, x0 + TILE_SIZE + TILE_OVERLAP), min(lh, y0 + TILE_SIZE + TILE_OVERLAP))
 
+    try:
+        with lock:
+            im = levels.get(factor)
+            if not streamable(im):
+                im.load()
+        plan = GeometryPlan(im)
+        for method in orientation:
+            plan.transpose(method)
+        tile = plan.crop(box).realize()
+        if fmt == 'jpeg' and tile.mode not in ('L', 'RGB', 'CMYK'):
+            tile = tile.convert('RGB')
+        file_k = derivative_path(route_file, key, fmt)
+        save_image(tile, file_k, fmt)
+    except OSError:
+        # 原图解码失败：丢掉内存里的金字塔，之后的请求经负缓存直接返回422
+        with TILE_LEVELS_LOCK:
+            TILE_LEVELS.pop(route_file, None)
+        return remember_failure(route_file, 422, 'decode err')
+    except Image.DecompressionBombError:
+        return failure_response(422, 'image too large', route_file)
+    return file_to_binary(file_k, fmt, 'tile', route_file)
+
+
+def purge_local(route_file):
+    """
+    清掉一张原图在本进程和本地磁盘上的所有缓存：衍生图、金字塔、负缓存、用作水印时的水印层
+    """
+    drop_derivatives(route_file)
+    with NEGATIVE_CACHE_LOCK:
+        NEGATIVE_CACHE.pop(route_file, None)
+    with WATERMARK_OVERLAYS_LOCK:
+        for key in [k for k in WATERMARK_OVERLAYS if k[0] == 'image' and k[1] == route_file]:
+            del WATERMARK_OVERLAYS[key]
+
+
+def cdn_paths(route_file):
+    """
+    一张原图在CDN上的所有地址：原图和衍生图（同一路径，不同参数）以及Deep Zoom描述文件和瓦片
+    """
+    path = quote('/' + route_file)
+    return [path, '/_dzi' + path + '.dzi', '/_dzi' + path + '_files/*']
+
+
+def cdn_invalidate(paths):
+    """
+    Cloud CDN按路径失效，同一路径下带不同查询参数的缓存一起失效；未配置CDN_URL_MAP时不做
+    :return: 每个路径的调用结果
+    """
+    if not CDN_URL_MAP:
+        return []
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+
+    credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    session = AuthorizedSession(credentials)
+    url = 'https://compute.googleapis.com/compute/v1/projects/{}/global/urlMaps/{}/invalidateCache'.format(
+        CDN_PROJECT or project, CDN_URL_MAP)
+    results = []
+    for path in paths:
+        body = {'path': path}
+        if CDN_HOST:
+            body['host'] = CDN_HOST
+        try:
+            r = session.post(url, json=body, timeout=ORIGIN_TIMEOUT)
+            results.append({'path': path, 'status': r.status_code})
+        except Exception as e:
+            results.append({'path': path, 'error': str(e)})
+    return results
+
+
+@app.route('/_purge/<path:route_file>', methods=['POST'])
+def purge(route_file):
+    """
+    原图重新上传后调用：清掉本地缓存，并让CDN上这张原图的所有地址失效。
+    其他pod上的衍生图在下一次命中时按原图版本作废
+    """
+    token = request.headers.get('X-Image-Purge')
+    if not PURGE_TOKEN or not token or not hmac.compare_digest(str(token), PURGE_TOKEN):
+        return 'forbidden', 403
+    purge_local(route_file)
+    paths = cdn_paths(route_file)
+    response = make_response(json.dumps({
+        'source': route_file,
+        'surrogate_key': surrogate_key(route_file),
+        'paths': paths,
+        'cdn': cdn_invalidate(paths),
+    }))
+    response.headers['Content-Type'] = 'application/json'
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/<re(r"[\w\W]*"):route_file>', methods=['GET', 'POST'])
+@profiled
+def image2(route_file):
+    request_file = re.split('/', route_file)[-1]
+    suffix = re.findall(r'\.[^.\\/:*?"<>|\r\n]+$', request_file)[0][1:]
+    k = ''
+    for i in request.args:
+        if re.findall(r'imageView2', i) or re.findall(r'imageMogr2', i) or i.split('/')[0] == WATER_MARK:
+            k = i
+        elif i.split('/')[0] == SRCSET:
+            return srcset(route_file, i)
+    if k:
+        if CANONICAL_REDIRECT and canonical_query(k) != k:
+            return canonical_redirect(route_file, k)
+        k = resolve_query(k, suffix)
+        cached = find_derivative(route_file, k)
+        if cached:
+            return file_to_binary(cached[0], cached[1], source=route_file)
+    failure = fetch_source(route_file)
+    if failure is not None:
+        return failure
+    if not k:
+        return file_to_binary(request_file, suffix, 'original', route_file)
+
+    budget = g.deadline - time.time()
+    if budget <= 0:
+        response = make_response('deadline exceeded', 504)
+        response.cache_control.no_store = True
+        return response
+
+    key = os.getcwd() + '/' + request_file
+    try:
+        source = open_source(key)
+    except OSError:
+        return remember_failure(route_file, 422, 'decode err')
+    if not schedule(job_cost(source, job_ops(k, source.format)), route_file):
+        source.close()
+        return busy_response()
+    # 排队用掉的时间也算在预算里
+    budget = g.deadline - time.time()
+    # 原图和处理过程中的中间图只在这个请求里用，返回前关闭原图释放文件句柄和像素
+    # 解码是惰性的，真正解码发生在realize/save_image里，损坏的原图也要在这里记成422
+    with source:
+        try:
+            im, type_, encode_args = process_query(plan_geometry(source), k, route_file)
+            # JPEG在解码时就能用draft缩小到1/2~1/8，不需要磁盘上的中间级
+            levels = open_levels(route_file, source) if source.format != 'JPEG' else None
+            if budget < DEGRADE_BUDGET:
+                # 取原图用掉了大部分预算：用fast缩放和编码，结果只用于这一次响应，不写入衍生图存储
+                if isinstance(im, GeometryPlan) and not im.preset:
+                    im.preset = 'fast'
+                encode_args['profile'] = encode_args.get('profile') or 'fast'
+                os.makedirs(DERIVATIVE_DIR, exist_ok=True)
+                file_k = os.path.join(DERIVATIVE_DIR, 'degraded-{}.{}'.format(uuid.uuid4().hex, type_))
+                save_image(realize(im, levels), file_k, type_, **encode_args)
+                response = file_to_binary(file_k, type_, 'degraded', route_file)
+                os.remove(file_k)
+                return response
+            file_k = derivative_path(route_file, k, type_)
+            save_image(realize(im, levels), file_k, type_, **encode_args)
+        except ValueError as e:
+            # 参数错误：400，和404/422一样只做短时间缓存
+            return failure_response(400, str(e), route_file)
+        except OSError:
+            return remember_failure(route_file, 422, 'decode err')
+        except Image.DecompressionBombError:
+            # 超过解压炸弹上限、又不能流式处理的操作：只拒绝这一个请求，同一原图的缩放/裁剪照常处理
+            return failure_response(422, 'image too large', route_file)
+    return file_to_binary(file_k, type_, source=route_file)
+
+if WARM_UP:
+    warm_up()
+else:
+    READY.set()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,238 @@
+"""
+衍生图等价性回归：同一批原图、同一批操作，分别用各引擎配置处理，
+和参考引擎生成的golden比较（尺寸必须一致，SSIM/PSNR不低于阈值），同时给出每个操作相对参考引擎的耗时比。
+需要numpy，在app.py所在目录运行：
+
+    python golden.py --update    # 用参考引擎重新生成golden，再比较各引擎
+    python golden.py             # 各引擎和golden比较，有不一致时退出码为1
+"""
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+
+import numpy
+from PIL import Image, ImageDraw
+
+import app
+
+GOLDEN_DIR = os.getenv('GOLDEN_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden'))
+# 原图目录，不存在时生成一套固定的合成图
+GOLDEN_CORPUS = os.getenv('GOLDEN_CORPUS', os.path.join(GOLDEN_DIR, 'corpus'))
+GOLDEN_SSIM = float(os.getenv('GOLDEN_SSIM', '0.98'))
+GOLDEN_PSNR = float(os.getenv('GOLDEN_PSNR', '35'))
+# 每个操作重复几次取最快的一次
+GOLDEN_REPEAT = int(os.getenv('GOLDEN_REPEAT', '3'))
+
+# 引擎配置：运行前把这些值设到app模块上。
+# reference复现改造前的行为：逐步PIL处理，PIL默认滤镜单次全尺寸重采样，不用draft和reducing_gap，golden由它生成
+ENGINES = collections.OrderedDict([
+    ('reference', {'FUSE_GEOMETRY': False, 'LEVEL_CACHE': False, 'STREAM_PIXELS': 0, 'RESAMPLE_PRESET': 'baseline'}),
+    ('fused', {'FUSE_GEOMETRY': True, 'LEVEL_CACHE': False, 'STREAM_PIXELS': 0, 'RESAMPLE_PRESET': app.RESAMPLE_PRESET}),
+    ('levels', {'FUSE_GEOMETRY': True, 'LEVEL_CACHE': True, 'STREAM_PIXELS': 0, 'RESAMPLE_PRESET': app.RESAMPLE_PRESET}),
+    ('vips', {'FUSE_GEOMETRY': True, 'LEVEL_CACHE': False, 'STREAM_PIXELS': 1, 'RESAMPLE_PRESET': app.RESAMPLE_PRESET}),
+])
+# 这些引擎和image2一样，非JPEG原图带上ImageLevels
+LEVEL_ENGINES = ('levels', 'vips')
+# vips用自己的缩放核并在解码时缩小，和PIL的结果本来就有差异，单独放宽阈值：(SSIM, PSNR)
+THRESHOLDS = {'vips': (0.9, 25.0)}
+
+OPS = [
+    'imageView2/1/w/200/h/200',
+    'imageView2/1/w/300',
+    'imageView2/2/w/300/h/200',
+    'imageView2/2/h/150',
+    'imageView2/2/w/100',
+    'imageView2/3/w/200/h/200',
+    'imageView2/4/w/300/h/200',
+    'imageView2/5/w/200/h/200',
+    'imageMogr2/crop/300x200/gravity/center',
+    'imageMogr2/crop/400x/gravity/east',
+    'imageMogr2/crop/300x200a20a10/gravity/northwest',
+    'imageMogr2/auto-orient/crop/200x200/gravity/southeast',
+    'imageMogr2/crop/300x200/gravity/smart',
+    'imageView2/1/w/200/h/200/gravity/smart',
+    'imageMogr2/rotate/90',
+    'imageMogr2/rotate/30',
+    'imageMogr2/blur/5x3',
+]
+
+
+def make_corpus(d):
+    """
+    固定的合成原图：大JPEG、大PNG、带EXIF方向的JPEG、带透明通道的PNG、灰度PNG
+    """
+    os.makedirs(d, exist_ok=True)
+    photo = Image.effect_mandelbrot((1600, 1067), (-2.2, -1.2, 1.0, 1.2), 64).convert('RGB')
+    draw = ImageDraw.Draw(photo)
+    for i in range(0, 1600, 40):
+        draw.line((i, 0, 1600 - i, 1067), fill=(i % 255, 80, 160), width=3)
+    draw.ellipse((500, 250, 1100, 850), outline=(200, 30, 30), width=12)
+    photo.save(os.path.join(d, 'photo.jpg'), quality=90)
+    photo.resize((4000, 2667), Image.BICUBIC).save(os.path.join(d, 'large.jpg'), quality=90)
+    # 缩到小尺寸时金字塔能用到2以上的级别，这些级别以有损JPEG存盘再读回
+    photo.resize((3200, 2134), Image.BICUBIC).save(os.path.join(d, 'large.png'))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    photo.resize((900, 600)).save(os.path.join(d, 'orient6.jpg'), quality=90, exif=exif)
+    alpha = photo.resize((900, 600)).convert('RGBA')
+    alpha.putalpha(Image.linear_gradient('L').resize((900, 600)))
+    alpha.save(os.path.join(d, 'alpha.png'))
+    photo.convert('L').resize((700, 900)).save(os.path.join(d, 'gray.png'))
+
+
+def apply_engine(engine):
+    for name, value in ENGINES[engine].items():
+        setattr(app, name, value)
+
+
+def run(path, op, engine):
+    """
+    按image2的方式处理一张图，返回处理结果（未编码）。
+    带上原图名，智能裁剪的焦点由第一个引擎算出后各引擎共用，比较的只是几何处理本身
+    """
+    apply_engine(engine)
+    name = os.path.basename(path)
+    suffix = name.rsplit('.', 1)[-1]
+    with Image.open(path) as source:
+        im, type_, encode_args = app.process_query(app.plan_geometry(source), app.resolve_query(op, suffix), name)
+        levels = app.open_levels(name, source) if engine in LEVEL_ENGINES and source.format != 'JPEG' else None
+        out = app.realize(im, levels)
+        out = out.copy() if out is source else out
+        out.load()
+    return out
+
+
+def settle():
+    """
+    等LevelStore的后台写盘全部完成
+    """
+    for t in threading.enumerate():
+        if t.daemon and t is not threading.current_thread():
+            t.join()
+
+
+def timed(path, op, engine):
+    if ENGINES[engine].get('LEVEL_CACHE'):
+        # 先跑一次生成金字塔并等写盘完成，之后计时和比较的都是从磁盘读回各级的结果
+        run(path, op, engine)
+        settle()
+    best = None
+    for _ in range(max(1, GOLDEN_REPEAT)):
+        begin = time.perf_counter()
+        out = run(path, op, engine)
+        cost = time.perf_counter() - begin
+        best = cost if best is None else min(best, cost)
+    return out, best
+
+
+def pixels(im, mode):
+    return numpy.asarray(im.convert(mode), dtype=numpy.float64).reshape(im.size[1], im.size[0], -1)
+
+
+def box_mean(a, r=3):
+    """
+    (2r+1)x(2r+1)窗口均值，边缘按镜像补齐
+    """
+    k = 2 * r + 1
+    c = numpy.pad(a, ((r, r), (r, r), (0, 0)), mode='reflect' if min(a.shape[:2]) > r else 'edge')
+    c = numpy.pad(c.cumsum(0).cumsum(1), ((1, 0), (1, 0), (0, 0)))
+    return (c[k:, k:] - c[:-k, k:] - c[k:, :-k] + c[:-k, :-k]) / (k * k)
+
+
+def compare(a, b):
+    """
+    :return: (SSIM, PSNR)，7x7窗口的平均SSIM，各通道取平均；带透明通道时按RGBA比较
+    """
+    mode = 'RGBA' if 'A' in a.getbands() + b.getbands() or 'transparency' in a.info else 'RGB'
+    x, y = pixels(a, mode), pixels(b, mode)
+    mse = ((x - y) ** 2).mean()
+    psnr = float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mx, my = box_mean(x), box_mean(y)
+    vx = box_mean(x * x) - mx * mx
+    vy = box_mean(y * y) - my * my
+    cov = box_mean(x * y) - mx * my
+    ssim = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return float(ssim.mean()), psnr
+
+
+def golden_path(image, op):
+    return os.path.join(GOLDEN_DIR, image, hashlib.sha1(op.encode('utf-8')).hexdigest()[:16] + '.png')
+
+
+def save_golden(image, op, im):
+    path = golden_path(image, op)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if im.mode not in ('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+    im.save(path)
+    return os.path.relpath(path, GOLDEN_DIR)
+
+
+def main():
+    update = '--update' in sys.argv[1:]
+    if not os.path.isdir(GOLDEN_CORPUS):
+        make_corpus(GOLDEN_CORPUS)
+    images = sorted(f for f in os.listdir(GOLDEN_CORPUS) if not f.startswith('.'))
+    index_path = os.path.join(GOLDEN_DIR, 'index.json')
+    index = {}
+    if os.path.exists(index_path) and not update:
+        with open(index_path) as fd:
+            index = json.load(fd)
+    # 金字塔写到临时目录，不碰线上的衍生图存储
+    app.DERIVATIVE_DIR = tempfile.mkdtemp(prefix='golden-')
+
+    failures = 0
+    speedups = collections.defaultdict(list)
+    worst = collections.defaultdict(lambda: (1.0, float('inf')))
+    with app.app.test_request_context():
+        for image in images:
+            path = os.path.join(GOLDEN_CORPUS, image)
+            for op in OPS:
+                reference, reference_cost = timed(path, op, 'reference')
+                if update:
+                    index.setdefault(image, {})[op] = save_golden(image, op, reference)
+                if op not in index.get(image, {}):
+                    print('{:<12} {:<48} missing golden, run with --update'.format(image, op))
+                    failures += 1
+                    continue
+                with Image.open(os.path.join(GOLDEN_DIR, index[image][op])) as stored:
+                    golden = stored.copy()
+                for engine in ENGINES:
+                    out, cost = (reference, reference_cost) if engine == 'reference' else timed(path, op, engine)
+                    if out.size != golden.size:
+                        print('{:<12} {:<48} {:<9} FAIL size {} != {}'.format(image, op, engine, out.size, golden.size))
+                        failures += 1
+                        continue
+                    ssim, psnr = compare(golden, out)
+                    min_ssim, min_psnr = THRESHOLDS.get(engine, (GOLDEN_SSIM, GOLDEN_PSNR))
+                    ok = ssim >= min_ssim and psnr >= min_psnr
+                    failures += 0 if ok else 1
+                    speedup = reference_cost / cost if cost else float('inf')
+                    speedups[engine].append(speedup)
+                    worst[engine] = (min(worst[engine][0], ssim), min(worst[engine][1], psnr))
+                    print('{:<12} {:<48} {:<9} {} ssim={:.4f} psnr={:>6.2f} {:>8.1f}ms x{:.2f}'.format(
+                        image, op, engine, 'ok  ' if ok else 'FAIL', ssim, psnr, cost * 1000, speedup))
+
+    if update:
+        os.makedirs(GOLDEN_DIR, exist_ok=True)
+        with open(index_path, 'w') as fd:
+            json.dump(index, fd, indent=1, sort_keys=True)
+    print()
+    for engine in ENGINES:
+        if speedups[engine]:
+            mean = math.exp(sum(math.log(s) for s in speedups[engine]) / len(speedups[engine]))
+            print('{:<9} speedup x{:.2f} (geomean)  worst ssim={:.4f} psnr={:.2f}'.format(
+                engine, mean, worst[engine][0], worst[engine][1]))
+    print('{} failure(s)'.format(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
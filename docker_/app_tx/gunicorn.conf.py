@@ -0,0 +1,21 @@
+import os
+
+# 和原来的命令行一致：--bind :$PORT --workers 1 --threads 8
+bind = ':' + os.getenv('PORT', '8080')
+workers = int(os.getenv('WORKERS', '1'))
+threads = int(os.getenv('THREADS', '8'))
+# master里导入app（包括预热）后再fork worker，worker不用各自导入和预热
+preload_app = True
+
+
+def post_fork(server, worker):
+    import app
+    app.warm_up_worker()
+
+
+def post_request(worker, req, environ, resp):
+    # 常驻内存超限时和max_requests一样让worker优雅退出：不再接新请求，处理完手上的再退出
+    import app
+    if worker.alive and app.should_recycle():
+        worker.log.info('worker rss %d over WORKER_MAX_RSS, recycling', app.current_rss())
+        worker.alive = False